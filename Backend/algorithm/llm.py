@@ -1,168 +1,559 @@
 import os
+import stat
 import torch
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
-    pipeline
 )
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
 from peft import PeftModel
 from dotenv import load_dotenv
-from typing import List, Dict, AsyncGenerator
+from typing import List, AsyncGenerator, Optional, Tuple
 import asyncio
-import traceback
-
-# LangChain Imports
-from langchain_huggingface import HuggingFacePipeline
-from langchain_core.messages import HumanMessage, AIMessage
+import threading
+import logging
+import time
+import uuid
 
 
 load_dotenv()
 
+# vLLM is opt-in (Linux only, see requirements-vllm.txt): with USE_VLLM=1 generation runs on its
+# AsyncLLMEngine (PagedAttention + continuous batching) instead of the batched transformers generate().
+# Chosen by the flag, not by importability, so a stray install never switches backends.
+USE_VLLM = os.getenv("USE_VLLM", "0") == "1"
+if USE_VLLM:
+    from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+    from vllm.lora.request import LoRARequest
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
 BASE_MODEL_ID = os.getenv("BASE_MODEL_ID")
 ADAPTER_PATH = os.getenv("ADAPTER_PATH")
+# Optional small model sharing the base tokenizer, used for speculative decoding
+DRAFT_MODEL_ID = os.getenv("DRAFT_MODEL_ID")
+NUM_SPECULATIVE_TOKENS = 5
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Allow TF32 tensor cores for any fp32 matmuls left on the path (bf16/4-bit layers are unaffected)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
 USE_QUANTIZATION = True
 bnb_config = None
 USE_ADAPTER = False
+# Off by default: with DynamicCache every new batch size / past length recompiles and re-records CUDA graphs,
+# and bnb 4-bit layers graph-break anyway. Only worth it on an unquantized model with fixed shapes.
+USE_TORCH_COMPILE = False # transformers path only; vLLM captures its own CUDA graphs
+
+# FlashAttention-2 tiles attention in SRAM instead of materializing QK^T; fall back to PyTorch SDPA
+try:
+    import flash_attn  # noqa: F401
+    ATTN_IMPLEMENTATION = "flash_attention_2"
+except ImportError:
+    ATTN_IMPLEMENTATION = "sdpa"
 
 if not BASE_MODEL_ID or not ADAPTER_PATH:
     raise ValueError("LLM configuration missing.")
 
 if USE_QUANTIZATION:
+     # NF4 + double quantization: ~0.5 bytes/param read per decode step instead of 2 (bf16)
      bnb_config = BitsAndBytesConfig(load_in_4bit=True,
-        bnb_4bit_compute_dtype=torch.bfloat16) 
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_compute_dtype=torch.bfloat16)
+
+# --- Generation Settings ---
+GENERATION_KWARGS = dict(
+    max_new_tokens=600,
+    temperature=0.4,
+    top_p=0.9,
+    top_k=50,
+    repetition_penalty=1.2,
+    do_sample=True,
+)
+# Requests arriving within MAX_WAIT_MS of each other share one generate() call. Batching is static:
+# a new batch starts only once the running one has finished, so a request arriving mid-generation
+# waits for the longest row of that batch (head-of-line blocking). Rows whose client went away are
+# stopped early, so an abandoned request does not hold the batch to max_new_tokens.
+MAX_BATCH = 8
+MAX_WAIT_MS = 5
+# Longest prompt (in tokens) fed to the model; older turns are cut from the left
+MAX_CTX = 4096
+# Yield to the caller once this much text is buffered or this long has passed
+COALESCE_CHARS = 16
+COALESCE_SECONDS = 0.05
+# Only the last MAX_HISTORY_MESSAGES messages (10 turns) are sent to the model
+MAX_HISTORY_MESSAGES = 20
+# Kinds of items yielded by generate_lc_response_stream (compared by identity in the SSE loop)
+TOKEN = "tok"
+ERROR = "err"
+
+# Chat history as (role, content) pairs
+ChatHistory = List[Tuple[str, str]]
 
 # --- Global Model State ---
 model = None
+draft_model = None
 tokenizer = None
-# Add LangChain LLM object
-lc_llm = None
+# vLLM engine (used instead of model when USE_VLLM)
+engine = None
+
+# Serializes loading so concurrent callers share one set of weights
+_load_lock = asyncio.Lock()
+
+# --- Batcher State (transformers path) ---
+_request_queue: Optional[asyncio.Queue] = None
+_batcher_task: Optional[asyncio.Task] = None
+
+def is_loaded() -> bool:
+    """True once either generation backend is ready."""
+    return engine is not None or model is not None
 
 def load_llm():
-    """Loads the LLM, tokenizer, and creates LangChain pipeline."""
-    global model, tokenizer, lc_llm
-    if lc_llm is not None:
-        print("LLM and LangChain Pipeline already loaded.")
+    """Loads the LLM and tokenizer (or the vLLM engine)."""
+    global model, draft_model, tokenizer, engine
+    if is_loaded():
+        logger.info("LLM already loaded.")
         return
 
+    # Fail before any download or weight load: the lifespan aborts and the server never starts half-configured.
+    # One stat: unlike os.path.exists/isdir it lets PermissionError through instead of reading as "missing".
+    if USE_ADAPTER:
+        try:
+            adapter_is_dir = stat.S_ISDIR(os.stat(ADAPTER_PATH).st_mode)
+        except FileNotFoundError:
+            adapter_is_dir = False
+        if not adapter_is_dir:
+            logger.critical(f"LLM - Adapter path not found: {ADAPTER_PATH}")
+            raise FileNotFoundError(f"LLM - Adapter path not found: {ADAPTER_PATH}")
+
     # --- Load Tokenizer ---
-    print(f"LLM - Loading tokenizer: {BASE_MODEL_ID}")
+    logger.info(f"Loading tokenizer: {BASE_MODEL_ID}")
     tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_ID, trust_remote_code=True)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
-        print("LLM - Set pad_token to eos_token")
-    print(f"LLM - Tokenizer EOS: {tokenizer.eos_token_id}, PAD: {tokenizer.pad_token_id}")
+        logger.info("Set pad_token to eos_token")
+    # Batched decoder-only generation needs the padding (and truncation) on the left
+    tokenizer.padding_side = "left"
+    tokenizer.truncation_side = "left"
+    logger.info(f"Tokenizer EOS: {tokenizer.eos_token_id}, PAD: {tokenizer.pad_token_id}")
+
+    # --- vLLM Engine ---
+    if USE_VLLM:
+        logger.info(f"Starting vLLM AsyncLLMEngine: {BASE_MODEL_ID} (Quantization: {USE_QUANTIZATION}, Adapter: {USE_ADAPTER})")
+        engine_args = AsyncEngineArgs(
+            model=BASE_MODEL_ID,
+            dtype="bfloat16",
+            quantization="bitsandbytes" if USE_QUANTIZATION else None,
+            load_format="bitsandbytes" if USE_QUANTIZATION else "auto",
+            enable_lora=USE_ADAPTER,
+            max_lora_rank=16,
+            # Reuse KV blocks of the shared conversation prefix, so turn N only prefills the new turn
+            enable_prefix_caching=True,
+            # Draft model proposes tokens that the base model verifies in one forward pass
+            speculative_config={"model": DRAFT_MODEL_ID, "num_speculative_tokens": NUM_SPECULATIVE_TOKENS} if DRAFT_MODEL_ID else None,
+            trust_remote_code=True,
+        )
+        engine = AsyncLLMEngine.from_engine_args(engine_args)
+        logger.info("vLLM engine initialized.")
+        return
 
     # --- Load Base Model ---
-    print(f"LLM - Loading base model: {BASE_MODEL_ID} (Quantization: {USE_QUANTIZATION})")
+    logger.info(f"Loading base model: {BASE_MODEL_ID} (Quantization: {USE_QUANTIZATION}, Attention: {ATTN_IMPLEMENTATION})")
     base_model = AutoModelForCausalLM.from_pretrained(
         BASE_MODEL_ID,
         quantization_config=bnb_config if USE_QUANTIZATION else None,
-        torch_dtype=torch.bfloat16,
+        torch_dtype=torch.bfloat16, # Still applies to the non-quantized modules (embeddings, norms, lm_head)
         trust_remote_code=True,
         device_map="auto",
-        attn_implementation="eager"
+        attn_implementation=ATTN_IMPLEMENTATION # FA2 / SDPA require fp16/bf16
     )
 
     # --- Conditionally Load Adapter ---
     if USE_ADAPTER:
-        print(f"LLM - Loading LoRA adapter from: {ADAPTER_PATH}")
-        if not os.path.exists(ADAPTER_PATH):
-            raise FileNotFoundError(f"LLM - Adapter path not found: {ADAPTER_PATH}")
+        logger.info(f"Loading LoRA adapter from: {ADAPTER_PATH}")
         try:
             # Assign loaded PEFT model to the global 'model' variable
-            print("LLM - Applying PEFT adapter to base model...")
+            logger.info("Applying PEFT adapter to base model...")
             model = PeftModel.from_pretrained(base_model, ADAPTER_PATH)
             model.eval()
-            print("LLM - PEFT Model loaded and assigned successfully.")
+            # Fold W0 + BA into the base weights so decode skips the extra adapter matmul per layer.
+            # With 4-bit weights peft dequantizes, merges and re-quantizes each layer (safe_merge checks for NaNs).
+            # The adapter can no longer be hot-swapped after this.
+            model = model.merge_and_unload(safe_merge=True)
+            logger.info("PEFT Model loaded and merged into base model successfully.")
         except Exception as e:
-            print(f"LLM - Error loading PEFT adapter: {e}")
+            logger.error(f"Error loading PEFT adapter: {e}")
             raise e
     else:
         # If not using adapter, assign the base model directly to the global model
-        print("LLM - Skipping adapter loading. Using BASE MODEL directly.")
+        logger.info("Skipping adapter loading. Using BASE MODEL directly.")
         model = base_model 
 
-    # --- Create Transformers Pipeline ---
-    print("LLM - Creating Transformers pipeline...")
-    pipe = pipeline(
-        "text-generation",
-        model=model, 
-        tokenizer=tokenizer,
-        device_map="auto", 
-        max_new_tokens=600, 
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+
+    # --- Load Draft Model (speculative decoding) ---
+    if DRAFT_MODEL_ID:
+        logger.info(f"Loading draft model for assisted generation: {DRAFT_MODEL_ID}")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            DRAFT_MODEL_ID,
+            torch_dtype=torch.bfloat16,
+            trust_remote_code=True,
+            # Place it where the base model already lives instead of dispatching it again
+            device_map={"": model.device},
+            attn_implementation=ATTN_IMPLEMENTATION
+        )
+        draft_model.eval()
+
+    # --- Compile Forward Pass ---
+    if USE_TORCH_COMPILE and DEVICE == "cuda":
+        # Weights are frozen from here on; reduce-overhead replays CUDA graphs for the decode step.
+        # dynamic=True because batch size and past length change between calls.
+        logger.info("Compiling forward pass (torch.compile, mode=reduce-overhead)...")
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
+    _warmup() # Also without compile: CUDA context, cuBLAS handles and allocator pools come up here
+    logger.info("Model ready for batched generation.")
+
+
+def _warmup():
+    """Runs a tiny generation so compilation/kernel setup happens at startup instead of on the first request."""
+    enc = _encode_batch([[("user", "Hello")]]).to(model.device)
+    with torch.inference_mode():
+        model.generate(**enc, max_new_tokens=4, do_sample=False)
+    logger.info("Warm-up generation done.")
+
+
+async def _warmup_vllm():
+    """Runs a tiny request through the vLLM engine (and the LoRA adapter, if enabled) before serving."""
+    lora_request = LoRARequest("adapter", 1, ADAPTER_PATH) if USE_ADAPTER else None
+    params = SamplingParams(max_tokens=4, temperature=0.0)
+    async for _ in engine.generate(_format_prompt([("user", "Hello")]), params, uuid.uuid4().hex, lora_request=lora_request):
+        pass
+    logger.info("vLLM warm-up request done.")
+
+
+async def get_engine():
+    """
+    Loads (and warms up) the model once per process and returns the active backend (vLLM engine or
+    transformers model). Called from the app lifespan, so uvicorn only accepts connections afterwards.
+    """
+    async with _load_lock:
+        if not is_loaded():
+            load_llm()
+            if engine is not None:
+                await _warmup_vllm()
+    return engine if engine is not None else model
+
+
+def _format_prompt(chat_history: ChatHistory) -> str:
+    """Renders user/assistant turns with the tokenizer's chat template (dicts are only built here)."""
+    conversation = [
+        {"role": role, "content": content or ""}
+        for role, content in chat_history if role in ("user", "assistant")
+    ]
+    return tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True)
+
+
+def _encode_batch(histories: List[ChatHistory]):
+    """Renders every history and tokenizes them in one padded call (fast tokenizer runs in Rust, without the GIL)."""
+    prompts = [_format_prompt(history) for history in histories]
+    if logger.isEnabledFor(logging.DEBUG):
+        for prompt in prompts:
+            logger.debug("Formatted prompt:\n%s", prompt)
+    return tokenizer(
+        prompts,
+        return_tensors="pt",
+        padding=True,
+        truncation=True,
+        max_length=MAX_CTX,
+        add_special_tokens=False, # The chat template already adds BOS
+    )
+
+
+async def _generate_vllm_stream(prompt: str) -> AsyncGenerator[str, None]:
+    """Streams the new text of each vLLM RequestOutput (outputs are cumulative)."""
+    sampling_params = SamplingParams(
         temperature=0.4,
         top_p=0.9,
         top_k=50,
         repetition_penalty=1.2,
-        do_sample=True,
-        eos_token_id=tokenizer.eos_token_id,
-        pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+        max_tokens=600,
     )
-    print("LLM - Transformers pipeline created.")
+    lora_request = LoRARequest("adapter", 1, ADAPTER_PATH) if USE_ADAPTER else None
+    prev_len = 0
+    async for output in engine.generate(prompt, sampling_params, uuid.uuid4().hex, lora_request=lora_request):
+        text = output.outputs[0].text
+        if len(text) > prev_len:
+            yield text[prev_len:]
+            prev_len = len(text)
 
-    # --- LangChain LLM Wrapper ---
-    lc_llm = HuggingFacePipeline(pipeline=pipe)
-    print("LLM - LangChain HuggingFacePipeline initialized.")
 
+class _BatchDispatcher:
+    """Decodes each row's new token ids and routes the text to that row's asyncio queue."""
 
-def _convert_history_to_lc_messages(chat_history: List[Dict[str, str]]):
-    """Converts standard chat history list to LangChain Message objects."""
-    messages = []
-    for msg in chat_history:
-        if msg.get("role") == "user":
-            messages.append(HumanMessage(content=msg.get("content", "")))
-        elif msg.get("role") == "assistant":
-            messages.append(AIMessage(content=msg.get("content", "")))
-        else:
-            pass
-    return messages
+    def __init__(self, loop: asyncio.AbstractEventLoop, queues: List[asyncio.Queue], cancelled: List[threading.Event]):
+        self.loop = loop
+        self.queues = queues
+        # Set by the consumer when its client disconnects; the token tap stops those rows
+        self.cancelled = cancelled
+        self.stop_ids = _stop_token_ids()
+        # Ids live in the token tap's preallocated host buffer; only per-row cursors are kept here
+        self.lengths = [0 for _ in queues]
+        # Incremental detokenization cursors: text is emitted for ids[read_offset:], decoded with the
+        # ids[prefix_offset:read_offset] window as context so word boundaries/merges come out right
+        self.prefix_offsets = [0 for _ in queues]
+        self.read_offsets = [0 for _ in queues]
+        self.finished = [False for _ in queues]
+        self.buf: Optional[torch.Tensor] = None # Token tap's host buffer, kept for the final decode in end()
+
+    def _send(self, row: int, item):
+        self.loop.call_soon_threadsafe(self.queues[row].put_nowait, item)
+
+    def push(self, buf: torch.Tensor, start: int, end: int):
+        """Consumes buf[start:end, :] (ids for steps start..end-1 of every row; buf is step-major)."""
+        self.buf = buf
+        for row in range(len(self.queues)):
+            if self.finished[row]:
+                continue # Padding emitted after this row's EOS
+            if self.cancelled[row].is_set():
+                self.finished[row] = True # Nobody is reading this row any more
+                continue
+            length = end
+            for offset, token_id in enumerate(buf[start:end, row].tolist()):
+                if token_id in self.stop_ids:
+                    self.finished[row] = True
+                    length = start + offset
+                    break
+            self.lengths[row] = length
+            delta = self._decode_delta(buf, row, final=self.finished[row])
+            if delta:
+                self._send(row, delta)
+            if self.finished[row]:
+                self._send(row, None)
+
+    def _decode_delta(self, buf: torch.Tensor, row: int, final: bool = False) -> str:
+        """
+        Decodes only the ids added since the last emitted text (O(new tokens), not O(response)).
+        final: the row has ended, so text held back for an incomplete character is emitted as is.
+        """
+        prefix_offset, read_offset, length = self.prefix_offsets[row], self.read_offsets[row], self.lengths[row]
+        window = buf[prefix_offset:length, row].tolist()
+        prefix_text = tokenizer.decode(window[:read_offset - prefix_offset], skip_special_tokens=True)
+        new_text = tokenizer.decode(window, skip_special_tokens=True)
+        # Hold back incomplete multi-byte characters until the next token completes them
+        if len(new_text) <= len(prefix_text) or (new_text.endswith("\ufffd") and not final):
+            return ""
+        self.prefix_offsets[row], self.read_offsets[row] = read_offset, length
+        return new_text[len(prefix_text):]
+
+    def end(self):
+        for row in range(len(self.queues)):
+            if not self.finished[row]:
+                self.finished[row] = True
+                if self.buf is not None:
+                    delta = self._decode_delta(self.buf, row, final=True)
+                    if delta:
+                        self._send(row, delta)
+                self._send(row, None)
+
+    def fail(self, error: Exception):
+        for row in range(len(self.queues)):
+            if not self.finished[row]:
+                self.finished[row] = True
+                self._send(row, error)
+
+
+class _TokenTap(StoppingCriteria):
+    """
+    Copies each step's new ids into pinned host memory on a side CUDA stream and hands them to the
+    dispatcher every POLL_EVERY steps, so the decode loop is not forced into a GPU->CPU sync per token
+    (a streamer receives `next_tokens.cpu()` every step). Only stops rows whose consumer was cancelled.
+    """
+    POLL_EVERY = 4
+
+    def __init__(self, dispatcher: _BatchDispatcher, batch_size: int, prompt_len: int, device: torch.device):
+        self.dispatcher = dispatcher
+        self.prompt_len = prompt_len
+        self.max_new = GENERATION_KWARGS["max_new_tokens"]
+        self.on_cuda = device.type == "cuda"
+        # Step-major (max_new, batch_size): each poll fills whole contiguous rows of pinned memory, so the
+        # non_blocking copy is a direct DMA instead of a staged copy into a strided column slice
+        self.host_buf = torch.empty((self.max_new, batch_size), dtype=torch.long, pin_memory=self.on_cuda)
+        self.side_stream = torch.cuda.Stream(device=device) if self.on_cuda else None
+        self.copied = 0      # Tokens enqueued for copy
+        self.dispatched = 0  # Tokens handed to the dispatcher
+        self.pending: List[Tuple[Optional[torch.cuda.Event], int]] = []
+        # Per-row stop mask; rebuilt (one small host->device copy) only when a row gets cancelled
+        self.stopped: Tuple[bool, ...] = (False,) * batch_size
+        self.stop_mask: Optional[torch.BoolTensor] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = min(input_ids.shape[1] - self.prompt_len, self.max_new)
+        if generated > self.copied:
+            new_ids = input_ids[:, self.prompt_len + self.copied:self.prompt_len + generated]
+            if self.on_cuda:
+                self.side_stream.wait_stream(torch.cuda.current_stream(input_ids.device))
+                input_ids.record_stream(self.side_stream) # Keep the source alive until the async copy lands
+                with torch.cuda.stream(self.side_stream):
+                    self.host_buf[self.copied:generated].copy_(new_ids.T, non_blocking=True)
+                    event = torch.cuda.Event()
+                    event.record(self.side_stream)
+            else:
+                self.host_buf[self.copied:generated].copy_(new_ids.T)
+                event = None
+            self.pending.append((event, generated))
+            self.copied = generated
+            if len(self.pending) >= self.POLL_EVERY:
+                self._drain(block=False)
+        stopped = tuple(event.is_set() for event in self.dispatcher.cancelled)
+        if self.stop_mask is None or stopped != self.stopped:
+            self.stopped = stopped
+            self.stop_mask = torch.tensor(stopped, dtype=torch.bool, device=input_ids.device)
+        return self.stop_mask
+
+    def _drain(self, block: bool):
+        ready = self.dispatched
+        while self.pending:
+            event, upto = self.pending[0]
+            if event is not None and not event.query():
+                if not block:
+                    break
+                event.synchronize()
+            ready = upto
+            self.pending.pop(0)
+        if ready > self.dispatched:
+            self.dispatcher.push(self.host_buf, self.dispatched, ready)
+            self.dispatched = ready
+
+    def finish(self):
+        self._drain(block=True)
+
+
+def _stop_token_ids() -> set:
+    eos = model.generation_config.eos_token_id
+    stop_ids = set(eos) if isinstance(eos, (list, tuple)) else {eos}
+    stop_ids.add(tokenizer.eos_token_id)
+    return stop_ids
+
+
+def _generate_with_tap(enc, dispatcher: _BatchDispatcher):
+    """Worker-thread body: runs generate() with the token tap, then flushes the tail."""
+    tap = _TokenTap(dispatcher, enc["input_ids"].shape[0], enc["input_ids"].shape[1], enc["input_ids"].device)
+    generate_kwargs = dict(GENERATION_KWARGS)
+    # transformers only supports assisted generation for a single sequence
+    if draft_model is not None and enc["input_ids"].shape[0] == 1:
+        generate_kwargs["assistant_model"] = draft_model
+    # inference_mode is thread-local, so it has to be entered inside the worker thread
+    with torch.inference_mode():
+        model.generate(**enc, stopping_criteria=StoppingCriteriaList([tap]), **generate_kwargs)
+    tap.finish()
 
 
-async def generate_lc_response_stream(chat_history: List[Dict[str, str]]) -> AsyncGenerator[str, None]:
-    """Generates response token by token asynchronously using LangChain."""
-    global lc_llm # Use the global LangChain LLM object
-    if lc_llm is None:
-        yield "[ERROR] LangChain LLM not loaded."
+async def _run_batch(batch: List[Tuple[ChatHistory, asyncio.Queue, threading.Event]]):
+    """Tokenizes the batch and runs one padded generate() call, both in worker threads."""
+    batch = [request for request in batch if not request[2].is_set()] # Clients gone while queued
+    if not batch:
+        return
+    histories = [history for history, _, _ in batch]
+    dispatcher = _BatchDispatcher(asyncio.get_running_loop(), [queue for _, queue, _ in batch], [cancelled for _, _, cancelled in batch])
+    try:
+        enc = (await asyncio.to_thread(_encode_batch, histories)).to(model.device)
+        logger.debug("Generating batch of %d (padded prompt length %d)", len(batch), enc["input_ids"].shape[1])
+        await asyncio.to_thread(_generate_with_tap, enc, dispatcher)
+        dispatcher.end()
+    except Exception as e:
+        logger.exception("Batched generation failed: %s", e)
+        dispatcher.fail(e)
+
+
+async def _batch_worker():
+    """
+    Drains up to MAX_BATCH queued histories (waiting at most MAX_WAIT_MS) and generates them together.
+    Only pulls the next batch once the current one is done (static batching, see MAX_BATCH).
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _request_queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_request_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        await _run_batch(batch)
+
+
+def _ensure_batcher():
+    global _request_queue, _batcher_task
+    if _batcher_task is None or _batcher_task.done():
+        _request_queue = asyncio.Queue()
+        _batcher_task = asyncio.create_task(_batch_worker())
+
+
+async def _generate_batched_stream(chat_history: ChatHistory) -> AsyncGenerator[str, None]:
+    """Queues the history for the batcher and yields its row's text as it is generated."""
+    _ensure_batcher()
+    queue: asyncio.Queue = asyncio.Queue()
+    cancelled = threading.Event() # Read from the generate() thread
+    await _request_queue.put((chat_history, queue, cancelled))
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Also reached when the client disconnects and the generator is closed: stop this row
+        cancelled.set()
+
+
+async def generate_lc_response_stream(chat_history: ChatHistory) -> AsyncGenerator[Tuple[str, str], None]:
+    """
+    Generates response token by token asynchronously (vLLM engine or batched transformers generate).
+    Yields (kind, payload) tuples: (TOKEN, text) for generated text, (ERROR, message) on failure.
+    """
+    if not is_loaded():
+        yield ERROR, "[ERROR] LLM not loaded."
         return
 
     try:
         # --- History Truncation ---
-        MAX_TURNS = 10
-        truncated_history_dicts = chat_history[-MAX_TURNS*2:]
-        print(f"LLM (LC) - Truncated history length: {len(truncated_history_dicts)}")
-
-        # --- Convert history to LangChain messages ---
-        lc_messages = _convert_history_to_lc_messages(truncated_history_dicts)
-        
-        # --- Log the prompt string the model actually sees ---
-        try:
-            # Attempt to format using the tokenizer's template logic
-            formatted_prompt_for_debug = tokenizer.apply_chat_template(
-                conversation=[msg.to_dict() for msg in lc_messages], # Convert LangChain messages back to dicts
-                tokenize=False,
-                add_generation_prompt=True
-            )
-            print(f"\n------ LANGCHAIN FORMATTED PROMPT ------\n{formatted_prompt_for_debug}\n-------------------------------------\n")
-        except Exception as e:
-            print(f"\n------ ERROR APPLYING CHAT TEMPLATE: {e} ------\n")
-            # Fallback: Simple manual formatting for debug viewing
-            simple_prompt = "\n".join([f"{msg.type.upper()}: {msg.content}" for msg in lc_messages]) + "\nASSISTANT:"
-            print(f"\n------ SIMPLE CONCATENATED PROMPT (for debug) ------\n{simple_prompt}\n-------------------------------------\n")
+        truncated_history = chat_history[-MAX_HISTORY_MESSAGES:]
+        logger.debug("Truncated history length: %d", len(truncated_history))
 
+        if engine is not None:
+            prompt = await asyncio.to_thread(_format_prompt, truncated_history)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Formatted prompt:\n%s", prompt)
+            stream = _generate_vllm_stream(prompt)
+        else:
+            # Template rendering + tokenization happen once per batch in the batcher
+            stream = _generate_batched_stream(truncated_history)
 
+        # --- Coalesce chunks so downstream SSE frames carry several tokens ---
         token_count = 0
-        async for chunk in lc_llm.astream(lc_messages):
+        buffer = ""
+        last_flush = time.monotonic()
+        async for chunk in stream:
             token_count += 1
-            yield chunk
-            await asyncio.sleep(0.01)
-
+            buffer += chunk
+            if len(buffer) >= COALESCE_CHARS or time.monotonic() - last_flush > COALESCE_SECONDS:
+                yield TOKEN, buffer
+                buffer = ""
+                last_flush = time.monotonic()
+        if buffer:
+            yield TOKEN, buffer
 
-        print(f"LLM (LC) - Streaming finished. Tokens yielded: {token_count}.")
+        logger.debug("Streaming finished. Tokens yielded: %d.", token_count)
 
     except Exception as e:
-        print(f"LLM (LC) - Error during LangChain stream generation: {e}")
-        traceback.print_exc()
-        yield f"[ERROR] Could not generate response via LangChain: {e}"
\ No newline at end of file
+        logger.exception("Error during stream generation: %s", e)
+        yield ERROR, f"[ERROR] Could not generate response: {e}"
@@ -1,7 +1,9 @@
 import os
 import asyncio
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import NullPool
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,7 +12,33 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("No DATABASE_URL found in environment variables")
 
-engine = create_async_engine(DATABASE_URL)
+# Set DB_BEHIND_PGBOUNCER=1 when connecting through pgbouncer in transaction mode (see DATABASE.md)
+DB_BEHIND_PGBOUNCER = os.getenv("DB_BEHIND_PGBOUNCER", "0").lower() in ("1", "true", "yes")
+# Compiled-SQL cache entries per engine (SQLAlchemy default is 500)
+QUERY_CACHE_SIZE = 1200
+
+if DB_BEHIND_PGBOUNCER:
+    # pgbouncer owns the pool; asyncpg must not keep server-side prepared statements across transactions
+    engine = create_async_engine(
+        DATABASE_URL,
+        poolclass=NullPool,
+        query_cache_size=QUERY_CACHE_SIZE,
+        connect_args={"prepared_statement_cache_size": 0, "statement_cache_size": 0},
+    )
+else:
+    # Explicit pool sizing: keep warm connections for concurrent requests/streams (asyncpg driver expected:
+    # postgresql+asyncpg://...). LIFO reuses the most recently returned (still warm) connection first.
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+        query_cache_size=QUERY_CACHE_SIZE,
+    )
+# expire_on_commit=False: objects returned by CRUD stay readable after the caller commits, without a
+# reload SELECT. Nothing relies on expiry to see fresh values; reads always re-query.
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -18,16 +46,43 @@ class Base(AsyncAttrs, DeclarativeBase):
 
 # --- Async Session Dependency ---
 async def get_db_session():
+    # The context manager closes the session on exit
     async with async_session_maker() as session:
-        try:
-            yield session
-        finally:
-            await session.close()
+        yield session
+
+
+def _create_missing_indexes(sync_conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+async def _ensure_message_fk_cascades(conn):
+    """Tables created before ON DELETE CASCADE was declared keep the old FK; switch it over once."""
+    result = await conn.execute(text(
+        "SELECT conname FROM pg_constraint "
+        "WHERE conrelid = 'chat_messages'::regclass AND contype = 'f' AND confdeltype <> 'c'"
+    ))
+    for (conname,) in result.all():
+        await conn.execute(text(
+            f'ALTER TABLE chat_messages DROP CONSTRAINT "{conname}", '
+            f'ADD CONSTRAINT "{conname}" FOREIGN KEY (session_id) REFERENCES chat_sessions (id) ON DELETE CASCADE'
+        ))
+        print(f"Database: Foreign key {conname} now cascades deletes.")
+
 
+# Arbitrary app-wide key for pg_advisory_xact_lock, serializing schema setup across workers
+SCHEMA_LOCK_KEY = 0x5EED_C4A7
 
 async def async_main():
     async with engine.begin() as conn:
+        # Every worker runs this at startup; the lock makes them take turns (released at commit),
+        # so the later ones see the tables/constraints instead of racing on CREATE/ALTER
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips existing tables entirely, so add indexes introduced later on their own
+        await conn.run_sync(_create_missing_indexes)
+        await _ensure_message_fk_cascades(conn)
     print("Database tables created (if they didn't exist).")
 
 
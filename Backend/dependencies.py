@@ -1,9 +1,43 @@
 # file: backend/dependencies.py
 from fastapi import Request, HTTPException, status, Depends
-from sqlalchemy.ext.asyncio import AsyncSession
 from .services import crud
 from .models import *
-from .database import get_db_session
+from .database import async_session_maker
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# --- Short-lived LRU user cache (user_id -> (expires_at, User)) ---
+USER_CACHE_TTL = 60.0
+USER_CACHE_MAX = 1024
+_user_cache: "OrderedDict[int, Tuple[float, User]]" = OrderedDict()
+
+
+def invalidate_user_cache(user_id: int) -> None:
+    """Drops the cached User for user_id (called on logout)."""
+    _user_cache.pop(user_id, None)
+
+
+async def _get_user_cached(user_id: int) -> Optional[User]:
+    """
+    TTL/LRU-cached user lookup. Misses open their own short DB session, so hits never
+    check a connection out of the pool.
+    """
+    entry = _user_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        _user_cache.move_to_end(user_id)
+        return entry[1]
+
+    async with async_session_maker() as db:
+        user = await crud.get_user_by_id(db, user_id=user_id)
+    if user is None:
+        _user_cache.pop(user_id, None)
+        return None
+    _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+    _user_cache.move_to_end(user_id)
+    if len(_user_cache) > USER_CACHE_MAX:
+        _user_cache.popitem(last=False)
+    return user
 
 
 async def get_current_user_id_from_session(request: Request) -> int:
@@ -31,13 +65,20 @@ async def get_current_user_id_from_session(request: Request) -> int:
 
 
 async def get_current_active_user(
-    user_id: int = Depends(get_current_user_id_from_session), 
-    db: AsyncSession = Depends(get_db_session)
+    request: Request,
+    user_id: int = Depends(get_current_user_id_from_session)
 ) -> User:
     """
-    Fetches the full User object from DB based on the authenticated user ID from session.
+    Fetches the full User object based on the authenticated user ID from session.
+    The result is memoized on request.state and in a short TTL/LRU cache keyed by user_id.
     """
-    user = await crud.get_user_by_id(db, user_id=user_id)
+    cached_user = getattr(request.state, "user", None)
+    if cached_user is not None:
+        return cached_user
+
+    user = await _get_user_cached(user_id)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return user
\ No newline at end of file
+
+    request.state.user = user
+    return user
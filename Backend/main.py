@@ -2,15 +2,19 @@ import os
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import asyncio
 
 # Use relative imports within the backend package
+from .logging_config import setup_logging, shutdown_logging
 from .algorithm import llm
 from .routes import router
 from .database import async_main # Import DB session dependency
 
 load_dotenv() # Load .env variables
+setup_logging()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY:
@@ -22,11 +26,11 @@ async def lifespan(the_app: FastAPI):
     print("Database: Creating tables...")
     await async_main()
     print("Backend: Loading LLM...")
-    llm.load_llm()
+    await llm.get_engine()
     print("Backend: LLM loaded.")
     yield
     print("Backend: Shutting down.")
-    # Cleanup if needed
+    shutdown_logging()
 
 app = FastAPI(lifespan=lifespan, title="Chat App Backend API")
 
@@ -38,5 +42,15 @@ app.add_middleware(
     # same_site="lax", 
 )
 
+# gzip JSON/HTML responses (e.g. long session histories); Starlette leaves text/event-stream uncompressed,
+# so SSE frames are still flushed to the client one by one
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
+# Browsers of a frontend running with BROWSER_STREAM_URL open /api/chat/stream/{id} here directly.
+# The stream id is the only credential (no cookies), so plain GETs from the listed origins are enough.
+STREAM_ALLOWED_ORIGINS = [o.strip() for o in os.getenv("STREAM_ALLOWED_ORIGINS", "").split(",") if o.strip()]
+if STREAM_ALLOWED_ORIGINS:
+    app.add_middleware(CORSMiddleware, allow_origins=STREAM_ALLOWED_ORIGINS, allow_methods=["GET"], allow_credentials=False)
+
 app.include_router(router)
 
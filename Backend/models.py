@@ -1,10 +1,16 @@
 from .database import Base
 from pydantic import BaseModel, EmailStr
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import String, Text, ForeignKey, BigInteger, func, DateTime
+from sqlalchemy import String, Text, ForeignKey, BigInteger, func, DateTime, Index
 import datetime
 from typing import List, Optional
+from typing_extensions import TypedDict # pydantic requires this TypedDict on Python < 3.12
 
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+# Timestamp columns carry a Python-side default next to the server default, so inserts from this app
+# know the value without reading it back (no refresh); rows inserted elsewhere still get now().
 class User(Base):
     __tablename__ = "chat_users"
 
@@ -12,10 +18,10 @@ class User(Base):
     email: Mapped[str] = mapped_column(String, unique=True, index=True, nullable=False)
     hashed_password: Mapped[str] = mapped_column(String, nullable=False)
     created_at: Mapped[datetime.datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now()
+        DateTime(timezone=True), default=_utcnow, server_default=func.now()
     )
 
-    sessions: Mapped[List["ChatSession"]] = relationship("ChatSession", back_populates="user", cascade="all, delete-orphan")
+    sessions: Mapped[List["ChatSession"]] = relationship("ChatSession", back_populates="user", cascade="all, delete-orphan", lazy="raise")
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
@@ -24,24 +30,32 @@ class ChatSession(Base):
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("chat_users.id"), nullable=False)
     title: Mapped[Optional[str]] = mapped_column(String)
     created_at: Mapped[datetime.datetime] = mapped_column(
-         DateTime(timezone=True), server_default=func.now()
+         DateTime(timezone=True), default=_utcnow, server_default=func.now()
     )
     last_updated_at: Mapped[datetime.datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+        DateTime(timezone=True), default=_utcnow, server_default=func.now(), onupdate=func.now()
     )
 
-    user: Mapped["User"] = relationship("User", back_populates="sessions")
-    messages: Mapped[List["ChatMessage"]] = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan", order_by="ChatMessage.timestamp")
+    # Loading a ChatSession entity always comes with its messages; reverse-direction lazy loads raise
+    user: Mapped["User"] = relationship("User", back_populates="sessions", lazy="raise")
+    # passive_deletes: the database's ON DELETE CASCADE removes messages, the ORM doesn't load them to delete
+    messages: Mapped[List["ChatMessage"]] = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan", order_by="ChatMessage.timestamp", lazy="selectin", passive_deletes=True)
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    # Postgres does not index FKs; this serves "WHERE session_id = ? ORDER BY timestamp" as a range scan
+    # (session_id, id) serves keyset pagination of a session's messages (WHERE id < :before ORDER BY id DESC)
+    __table_args__ = (
+        Index("ix_chat_messages_session_ts", "session_id", "timestamp"),
+        Index("ix_chat_messages_session_id_id", "session_id", "id"),
+    )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, index=True)
-    session_id: Mapped[str] = mapped_column(String, ForeignKey("chat_sessions.id"), nullable=False)
+    session_id: Mapped[str] = mapped_column(String, ForeignKey("chat_sessions.id", ondelete="CASCADE"), nullable=False)
     role: Mapped[str] = mapped_column(String, nullable=False) # "user" or "assistant"
     content: Mapped[str] = mapped_column(Text, nullable=False)
     timestamp: Mapped[datetime.datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now()
+        DateTime(timezone=True), default=_utcnow, server_default=func.now()
     )
 
     session: Mapped["ChatSession"] = relationship("ChatSession", back_populates="messages")
@@ -63,24 +77,28 @@ class UserPublic(BaseModel):
     class Config:
         from_attributes = True 
 
-class SessionInfo(BaseModel):
+# Child/list schemas are TypedDicts: plain dicts, validated without per-item model instances
+class SessionInfo(TypedDict):
     id: str
-    title: Optional[str] = None
+    title: Optional[str]
     last_updated_at: datetime.datetime
 
-    class Config:
-        from_attributes = True
-
-class MessageInfo(BaseModel):
+class MessageInfo(TypedDict):
     id: int
     role: str
     content: str
-    timestamp: datetime.datetime 
-    class Config:
-        from_attributes = True
+    timestamp: datetime.datetime
+
+class MessagePage(TypedDict):
+    messages: List[MessageInfo] # Oldest first
+    has_more: bool # Older messages exist before messages[0]
 
-class SessionDetail(SessionInfo):
-    messages: List[MessageInfo] = []
+class SessionDetail(BaseModel):
+    id: str
+    title: Optional[str] = None
+    last_updated_at: datetime.datetime
+    messages: List[MessageInfo] = [] # Latest page only, see has_more
+    has_more: bool = False
 
 class InitiateChatRequestApi(BaseModel): 
     session_id: Optional[str] = None 
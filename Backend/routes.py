@@ -1,21 +1,31 @@
 # file: Backend/routes.py
 import asyncio
 import uuid
+import orjson
 import traceback # Import traceback
-from fastapi import APIRouter, HTTPException, Depends, status, Request
-from fastapi.responses import StreamingResponse
-from typing import List, Dict, Optional, AsyncGenerator
+from fastapi import APIRouter, HTTPException, Depends, status, Request, Query
+from fastapi.responses import StreamingResponse, Response
+from typing import List, Optional, AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession
+from limits import parse as parse_rate_limit
+from limits.storage import MemoryStorage
+from limits.strategies import MovingWindowRateLimiter
+from cachetools import LRUCache
 
 # Use relative imports
-from .services import crud, auth
+from .services import crud, auth, stream_store
 from .database import get_db_session, async_session_maker 
-from .dependencies import get_current_active_user, get_current_user_id_from_session
-from .models import User, UserCreate, UserLogin, UserPublic, SessionInfo, SessionDetail, InitiateChatRequestApi, InitiateChatResponseApi
+from .dependencies import get_current_active_user, get_current_user_id_from_session, invalidate_user_cache
+from .models import User, UserCreate, UserLogin, UserPublic, SessionInfo, MessageInfo, MessagePage, SessionDetail, InitiateChatRequestApi, InitiateChatResponseApi
 from .algorithm import llm
 
 router = APIRouter(prefix="/api", tags=["ChatApp"]) 
 
+# Login attempts are limited per submitted email: every request arrives through the frontend's shared
+# HTTP client, so the client IP would be the same for all users. Counters are per process (per worker).
+LOGIN_RATE_LIMIT = parse_rate_limit("5/minute")
+_login_limiter = MovingWindowRateLimiter(MemoryStorage())
+
 # --- Auth Routes ---
 @router.post("/signup", response_model=UserPublic, status_code=status.HTTP_201_CREATED)
 async def api_signup(user_data: UserCreate, db: AsyncSession = Depends(get_db_session)):
@@ -28,8 +38,13 @@ async def api_signup(user_data: UserCreate, db: AsyncSession = Depends(get_db_se
 # --- Login Route ---
 @router.post("/login")
 async def api_login(request: Request, form_data: UserLogin, db: AsyncSession = Depends(get_db_session)):
+    if not _login_limiter.hit(LOGIN_RATE_LIMIT, "login", form_data.email.strip().lower()):
+        raise HTTPException(status_code=429, detail="Too many login attempts. Try again in a minute.")
     user = await crud.get_user_by_email(db, email=form_data.email)
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+    # Unknown emails still pay for one bcrypt check (against a dummy hash) so timing doesn't reveal them
+    target_hash = user.hashed_password if user else auth.DUMMY_PASSWORD_HASH
+    password_ok = await auth.verify_password_async(form_data.password, target_hash)
+    if not user or not password_ok:
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     request.session["user_id"] = user.id
     request.session["email"] = user.email
@@ -39,27 +54,73 @@ async def api_login(request: Request, form_data: UserLogin, db: AsyncSession = D
 # --- Logout Route ---
 @router.post("/logout")
 async def api_logout(request: Request):
+    user_id = request.session.get("user_id")
+    if user_id is not None:
+        try: invalidate_user_cache(int(user_id))
+        except (ValueError, TypeError): pass
     request.session.clear()
     print("API: Session cleared.")
     return {"message": "Logout successful"}
 
+# Read-only routes below use response_model=None: they return server-built values straight from
+# our own DB, so output validation is skipped. Input models (UserCreate, UserLogin, ...) stay validated.
+
 # --- User Route ---
-@router.get("/users/me", response_model=UserPublic)
-async def api_read_users_me(current_user: User = Depends(get_current_active_user)):
-    return current_user
+@router.get("/users/me", response_model=None)
+async def api_read_users_me(current_user: User = Depends(get_current_active_user)) -> UserPublic:
+    return UserPublic.model_construct(id=current_user.id, email=current_user.email)
 
 # --- Session Routes ---
-@router.get("/sessions", response_model=List[SessionInfo])
-async def api_get_sessions(user_id: int = Depends(get_current_user_id_from_session), db: AsyncSession = Depends(get_db_session)):
-    sessions = await crud.get_user_sessions(db, user_id=user_id)
-    return sessions
+# Pre-encoded SessionInfo JSON per session id, valid while last_updated_at is unchanged
+# (every new message bumps it). Unchanged rows skip encoding; the list is a byte join.
+_session_json: LRUCache = LRUCache(maxsize=50_000)
+
+def _session_fragment(row) -> bytes:
+    cached = _session_json.get(row.id)
+    if cached is not None and cached[0] == row.last_updated_at:
+        return cached[1]
+    fragment = orjson.dumps(SessionInfo(id=row.id, title=row.title, last_updated_at=row.last_updated_at))
+    _session_json[row.id] = (row.last_updated_at, fragment)
+    return fragment
+
+@router.get("/sessions", response_model=None)
+async def api_get_sessions(user_id: int = Depends(get_current_user_id_from_session), db: AsyncSession = Depends(get_db_session)) -> Response:
+    """List of SessionInfo objects, assembled from cached per-session JSON fragments."""
+    rows = await crud.get_user_sessions(db, user_id=user_id)
+    body = b"[" + b",".join(_session_fragment(r) for r in rows) + b"]"
+    return Response(content=body, media_type="application/json")
 
 # --- Session Detail Route ---
-@router.get("/sessions/{session_id}", response_model=SessionDetail)
-async def api_get_session_details(session_id: str, user_id: int = Depends(get_current_user_id_from_session), db: AsyncSession = Depends(get_db_session)):
-    session = await crud.get_session_by_id(db, session_id=session_id, user_id=user_id)
-    if not session: raise HTTPException(status_code=404, detail="Session not found")
-    return session
+@router.get("/sessions/{session_id}", response_model=None)
+async def api_get_session_details(session_id: str, user_id: int = Depends(get_current_user_id_from_session), db: AsyncSession = Depends(get_db_session)) -> SessionDetail:
+    """Session info plus its newest page of messages (older pages via /sessions/{id}/messages)."""
+    info, rows, has_more = await crud.get_session_detail(db, session_id=session_id, user_id=user_id)
+    if not info: raise HTTPException(status_code=404, detail="Session not found")
+    return SessionDetail.model_construct(
+        id=info.id,
+        title=info.title,
+        last_updated_at=info.last_updated_at,
+        messages=[MessageInfo(id=m.id, role=m.role, content=m.content, timestamp=m.timestamp) for m in rows],
+        has_more=has_more,
+    )
+
+# --- Session Messages Page Route ---
+@router.get("/sessions/{session_id}/messages", response_model=None)
+async def api_get_session_messages(
+    session_id: str,
+    before: Optional[int] = None,
+    limit: int = Query(crud.MESSAGE_PAGE_SIZE, ge=1, le=200),
+    user_id: int = Depends(get_current_user_id_from_session),
+    db: AsyncSession = Depends(get_db_session)
+) -> MessagePage:
+    """Keyset pagination: messages older than message id `before`, oldest first."""
+    if not await crud.get_session_meta(db, session_id=session_id, user_id=user_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    rows, has_more = await crud.get_session_messages(db, session_id=session_id, before_id=before, limit=limit)
+    return MessagePage(
+        messages=[MessageInfo(id=m.id, role=m.role, content=m.content, timestamp=m.timestamp) for m in rows],
+        has_more=has_more,
+    )
 
 # --- Delete Session Route ---
 @router.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -69,7 +130,20 @@ async def api_delete_session(session_id: str, user_id: int = Depends(get_current
     return None
 
 # --- Chat Routes ---
-stream_contexts: Dict[str, Dict] = {} # Store context info
+SSE_FLUSH_TOKENS = 16
+SSE_FLUSH_SECONDS = 0.02
+# The streamed response is saved at most once per PERSIST_SECONDS, or sooner after PERSIST_CHARS new characters
+PERSIST_SECONDS = 1.0
+PERSIST_CHARS = 4096
+
+def _sse_data(text: str) -> bytes:
+    """Encodes text as one SSE event; embedded newlines become extra data: lines (joined by the client)."""
+    if "\n" not in text:
+        return b"data: " + text.encode("utf-8") + b"\n\n"
+    return b"".join(b"data: " + line + b"\n" for line in text.encode("utf-8").split(b"\n")) + b"\n"
+
+def _sse_error(message: str) -> bytes:
+    return b"event: error\ndata: " + orjson.dumps({"error": message}) + b"\n\n"
 
 @router.post("/chat/initiate", response_model=InitiateChatResponseApi)
 async def api_initiate_chat(
@@ -77,36 +151,33 @@ async def api_initiate_chat(
     user_id: int = Depends(get_current_user_id_from_session),
     db: AsyncSession = Depends(get_db_session)
 ):
-    if llm.model is None: raise HTTPException(status_code=503, detail="LLM not loaded")
+    if not llm.is_loaded(): raise HTTPException(status_code=503, detail="LLM not loaded")
     session_id = request_data.session_id
     user_message_content = request_data.user_message
 
-    # Use transaction block for session creation AND message adding
+    # Use transaction block for session creation, history load AND message adding
     async with db.begin():
         if session_id:
-            session = await crud.get_session_by_id(db, session_id=session_id, user_id=user_id)
-            if not session: raise HTTPException(status_code=404, detail="Session not found")
+            if not await crud.get_session_meta(db, session_id=session_id, user_id=user_id):
+                raise HTTPException(status_code=404, detail="Session not found")
+            # Only the tail the model will see; the new user message below completes it
+            history_for_llm = await crud.get_session_history(db, session_id=session_id, limit=llm.MAX_HISTORY_MESSAGES - 1)
         else:
             session = await crud.create_chat_session(db, user_id=user_id, title=user_message_content[:50])
             session_id = session.id
+            history_for_llm = []
             print(f"API: Created new session {session_id} for user {user_id}")
 
         user_message = await crud.add_chat_message(
-            db, session_id=session_id, role="user", content=user_message_content
+            db, session_id=session_id, user_id=user_id, role="user", content=user_message_content
         )
 
-
-    # Fetch history *after* transaction is committed
-    updated_session = await crud.get_session_by_id(db, session_id=session_id, user_id=user_id)
-    # Ensure messages are loaded
-    if not updated_session or not hasattr(updated_session, 'messages'):
-         raise HTTPException(status_code=500, detail="Failed to load session messages after update")
-
-    history_for_llm = [{"role": msg.role, "content": msg.content} for msg in updated_session.messages]
-    print(f"History for LLM ({len(history_for_llm)} messages): {history_for_llm}") # Log history
+    # History is built in memory; no reload of the session after the commit
+    history_for_llm.append((user_message.role, user_message.content))
+    print(f"API: History for LLM has {len(history_for_llm)} messages")
 
     stream_id = str(uuid.uuid4())
-    stream_contexts[stream_id] = {'history': history_for_llm, 'session_id': session_id, 'user_id': user_id}
+    await stream_store.put_context(stream_id, {'history': history_for_llm, 'session_id': session_id, 'user_id': user_id})
     print(f"API: Initiated stream {stream_id} for session {session_id}")
 
     return InitiateChatResponseApi(session_id=session_id, user_message_id=user_message.id, stream_id=stream_id)
@@ -116,75 +187,125 @@ async def api_stream_chat(stream_id: str):
     """Handles the SSE connection, filters <think> tags, and streams the final response."""
     print(f"API: SSE connection requested for stream ID: {stream_id}")
 
-    # LLM object check now implicitly checks if lc_llm is loaded
-    if llm.lc_llm is None:
+    # Checks whichever generation backend (vLLM engine or transformers batcher) is in use
+    if not llm.is_loaded():
          raise HTTPException(status_code=503, detail="LLM not loaded yet")
 
-    context = stream_contexts.pop(stream_id, None)
+    context = await stream_store.pop_context(stream_id)
     if not context:
          print(f"API: Stream ID {stream_id} not found or already processed.")
          raise HTTPException(status_code=404, detail="Stream session not found or expired")
 
     history = context['history']
     session_id = context['session_id']
-
-    async def event_generator():
-        """Generator yields tokens AFTER the last </think> tag and saves that part."""
-        full_response = ""
+    user_id = context['user_id']
+
+    async def event_generator() -> AsyncGenerator[bytes, None]:
+        """
+        Yields pre-encoded SSE frames (bytes go straight to send()). Frames never wait on the database:
+        the response is saved in the background every PERSIST_SECONDS / PERSIST_CHARS, so a partial
+        response survives a disconnect. The assistant row is only inserted once it has content.
+        """
+        # Tokens are coalesced into one SSE frame per SSE_FLUSH_TOKENS tokens or SSE_FLUSH_SECONDS
+        loop = asyncio.get_running_loop()
+        buf: List[str] = []
+        parts: List[str] = [] # Everything sent so far
+        response_length = 0
+        last_flush = loop.time()
+        error_message: Optional[str] = None
         llm_error_occurred = False
 
+        db_session = async_session_maker()
+        assistant_message_id: Optional[int] = None
+        persisted_length = 0
+        last_persist = loop.time()
+        persist_task: Optional[asyncio.Task] = None
+        persist_ok = True
+
+        async def persist(content: str):
+            """Inserts the assistant message on first save, then overwrites its content (one row version per save)."""
+            nonlocal assistant_message_id, persisted_length, persist_ok
+            try:
+                async with db_session.begin():
+                    if assistant_message_id is None:
+                        message = await crud.add_chat_message(db_session, session_id, user_id, "assistant", content)
+                        assistant_message_id = message.id
+                    else:
+                        await crud.set_chat_message_content(db_session, assistant_message_id, content)
+                persisted_length = len(content)
+            except Exception as db_err:
+                persist_ok = False
+                print(f"API: CRITICAL - Failed to save assistant message for session {session_id}: {db_err}")
+                traceback.print_exc()
+
+        def flush() -> bytes:
+            """Encodes the buffered text as one SSE frame; starts a background save when one is due."""
+            nonlocal response_length, last_persist, persist_task
+            delta = "".join(buf)
+            buf.clear()
+            parts.append(delta)
+            response_length += len(delta)
+            now = loop.time()
+            if persist_ok and (persist_task is None or persist_task.done()) and (
+                    response_length - persisted_length >= PERSIST_CHARS or now - last_persist >= PERSIST_SECONDS):
+                last_persist = now
+                persist_task = asyncio.create_task(persist("".join(parts)))
+            return _sse_data(delta)
 
         try:
             token_count = 0
-            print(f"API: Starting LangChain LLM stream for {stream_id}")
-            async for token in llm.generate_lc_response_stream(history):
-                token_count += 1
-
-                if "[ERROR]" in token:
-                    print(f"API: LLM Error received via LangChain stream {stream_id}: {token}")
-                    full_response = token # Store error message
+            print(f"API: Starting LLM stream for {stream_id}")
+            async for kind, token in llm.generate_lc_response_stream(history):
+                if kind is llm.ERROR:
+                    print(f"API: LLM Error received in stream {stream_id}: {token}")
+                    if buf:
+                        yield flush()
+                    error_message = token # Store error message
                     llm_error_occurred = True
-                    yield f"data: {token}\n\n" # Send error to client
+                    yield _sse_error(token) # Send error to client
                     break
 
-                # --- Yield token directly (NO filtering) ---
-                full_response += token
-                sse_data = f"data: {token}\n\n"
-                yield sse_data
-                # --- End direct yield ---
-
-                await asyncio.sleep(0.01)
+                # --- Buffer token (NO filtering) ---
+                token_count += 1
+                buf.append(token)
+                if len(buf) >= SSE_FLUSH_TOKENS or loop.time() - last_flush > SSE_FLUSH_SECONDS:
+                    yield flush()
+                    last_flush = loop.time()
 
-            print(f"API: LangChain Streaming finished for {stream_id}. Tokens received: {token_count}.")
+            if buf:
+                yield flush()
+            print(f"API: LLM stream finished for {stream_id}. Tokens received: {token_count}.")
 
         except Exception as e:
             llm_error_occurred = True
-            full_response = f"[ERROR] Streaming failed unexpectedly in generator: {e}"
+            error_message = f"[ERROR] Streaming failed unexpectedly in generator: {e}"
             print(f"API: Error during event_generator for {stream_id}: {e}")
-            try: yield f"data: {full_response}\n\n"
+            try: yield _sse_error(error_message)
             except Exception: pass
         finally:
-            # --- Save the FULL raw response ---
-            final_content_to_save = full_response.strip() # Use the raw response
-
-            if not llm_error_occurred and final_content_to_save:
-                print(f"API: Attempting to save FULL response for session {session_id}. Length: {len(final_content_to_save)}")
-                try:
-                    async with async_session_maker() as db_session:
+            # --- Final save, or drop what was saved ---
+            try:
+                if persist_task is not None:
+                    await persist_task # The session is not shared concurrently: let the running save finish first
+                if llm_error_occurred or response_length == 0:
+                    if assistant_message_id is not None:
+                        print(f"API: Discarding assistant message {assistant_message_id} due to error or empty response for stream {stream_id}.")
                         async with db_session.begin():
-                            await crud.add_chat_message(db_session, session_id, "assistant", final_content_to_save)
-                        print(f"API: Successfully saved FULL assistant message for session {session_id}")
-                except Exception as db_err:
-                    print(f"API: CRITICAL - Failed to save FULL assistant message for session {session_id}: {db_err}")
-                    traceback.print_exc() # Print the full traceback for debugging
-            elif not final_content_to_save and not llm_error_occurred:
-                 print(f"API: No response generated for stream {stream_id}, not saving.")
-            else: 
-                print(f"API: Skipping DB save due to error or empty response for stream {stream_id}.")
+                            await crud.delete_chat_message(db_session, assistant_message_id)
+                elif persist_ok:
+                    if persisted_length < response_length:
+                        await persist("".join(parts))
+                    if persist_ok:
+                        print(f"API: Saved assistant message {assistant_message_id} for session {session_id}. Length: {response_length}")
+            except Exception as db_err:
+                print(f"API: CRITICAL - Failed to finalize assistant message for session {session_id}: {db_err}")
+                traceback.print_exc() # Print the full traceback for debugging
+            finally:
+                await db_session.close()
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 # --- Health Check ---
 @router.get("/health")
 async def health_check():
-    return {"status": "ok", "model_loaded": llm.model is not None}
\ No newline at end of file
+    return {"status": "ok", "model_loaded": llm.is_loaded()}
\ No newline at end of file
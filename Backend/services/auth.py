@@ -1,5 +1,7 @@
 import os
-from passlib.context import CryptContext
+import asyncio
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 
@@ -10,13 +12,29 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY:
     raise ValueError("No SECRET_KEY found in environment variables")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = 12
+# bcrypt gets its own small pool: a signup/login burst can't flood the default executor
+# (which also runs tokenization and generation threads) and is capped at a few cores
+BCRYPT_MAX_WORKERS = 4
+_bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
 
+# bcrypt is called directly (no passlib dispatch); both calls are CPU-bound, use the *_async wrappers from async code
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     try:
-        return pwd_context.verify(plain_password, hashed_password)
+        return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
     except Exception:
         return False
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
\ No newline at end of file
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bcrypt_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bcrypt_executor, get_password_hash, password)
+
+# Verified against when the email is unknown, so a miss costs the same bcrypt time as a wrong password
+DUMMY_PASSWORD_HASH = get_password_hash("dummy-password-for-timing")
@@ -1,115 +1,291 @@
-from sqlalchemy import select, update, delete, func
+from sqlalchemy import select, insert, update, delete, func, bindparam, event, Row
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload 
+from sqlalchemy.orm import Session
 from ..models import User, ChatSession, ChatMessage
-from .auth import get_password_hash
+from .auth import get_password_hash_async
+import asyncio
+import logging
 import uuid
-from typing import List, Optional
+from cachetools import TTLCache
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_PAGE_SIZE = 50
+
+# --- Session list cache (user_id -> rows) ---
+# Short TTL bounds staleness from a write racing a read; every mutating call below also invalidates.
+# The cache is per process: with several workers, the others may serve a list up to 5 s old.
+_sessions_cache: TTLCache = TTLCache(maxsize=10_000, ttl=5)
+
+def invalidate_user_sessions(user_id: int) -> None:
+    _sessions_cache.pop(user_id, None)
+
+def _invalidate_user_sessions_on_commit(db: AsyncSession, user_id: int) -> None:
+    """
+    For writes inside the caller's transaction: invalidating before the commit would let a concurrent
+    read cache the pre-commit list again, so the entry is dropped once the transaction commits.
+    """
+    db.info.setdefault("invalidate_sessions", set()).add(user_id)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_sessions(session: Session) -> None:
+    for user_id in session.info.pop("invalidate_sessions", ()):
+        invalidate_user_sessions(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back_invalidations(session: Session) -> None:
+    session.info.pop("invalidate_sessions", None)
+
+# --- Hot-path statements ---
+# Built once with bind parameters: every call reuses the same statement object, so SQLAlchemy's
+# compiled cache (query_cache_size on the engine) hits without rebuilding the Core construct per request.
+_SEL_USER_BY_EMAIL = select(User).where(User.email == bindparam("email"))
+_SEL_USER_SESSIONS = (
+    select(ChatSession.id, ChatSession.title, ChatSession.last_updated_at)
+    .where(ChatSession.user_id == bindparam("user_id"))
+    .order_by(ChatSession.last_updated_at.desc())
+)
+_SEL_SESSION_META = (
+    select(ChatSession.id)
+    .where(ChatSession.id == bindparam("session_id"), ChatSession.user_id == bindparam("user_id"))
+    .limit(1)
+)
+_SEL_SESSION_INFO = (
+    select(ChatSession.id, ChatSession.title, ChatSession.last_updated_at)
+    .where(ChatSession.id == bindparam("session_id"), ChatSession.user_id == bindparam("user_id"))
+)
+_SEL_SESSION_HISTORY = (
+    select(ChatMessage.role, ChatMessage.content)
+    .where(ChatMessage.session_id == bindparam("session_id"))
+    .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+    .limit(bindparam("limit"))
+)
+
+# --- Per-request user cache ---
+# Lives in db.info, i.e. exactly as long as the AsyncSession (one request), so it can never go stale
+# across requests. Also remembers misses, which the identity map does not.
+def _user_cache(db: AsyncSession) -> dict:
+    return db.info.setdefault("user_cache", {})
 
 async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
-    result = await db.execute(select(User).filter(User.email == email))
-    return result.scalar_one_or_none()
+    cache = _user_cache(db)
+    key = ("email", email) # Exact match, like the query itself
+    if key not in cache:
+        result = await db.execute(_SEL_USER_BY_EMAIL, {"email": email})
+        cache[key] = result.scalar_one_or_none()
+    return cache[key]
 
 async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[User]:
-    result = await db.execute(select(User).filter(User.id == user_id))
-    return result.scalar_one_or_none()
+    cache = _user_cache(db)
+    key = ("id", user_id)
+    if key not in cache:
+        # Primary-key get: served from the session's identity map without SQL when already loaded
+        cache[key] = await db.get(User, user_id)
+    return cache[key]
 
 async def create_user(db: AsyncSession, email: str, password: str) -> User:
-    hashed_password = get_password_hash(password)
-    db_user = User(email=email, hashed_password=hashed_password)
-    db.add(db_user)
+    # Hash off the event loop (bounded bcrypt pool)
+    hashed_password = await get_password_hash_async(password)
+    # RETURNING gives the generated id/created_at without a refresh SELECT
+    stmt = (
+        insert(User)
+        .values(email=email, hashed_password=hashed_password)
+        .returning(User.id, User.created_at)
+    )
+    row = (await db.execute(stmt)).one()
     await db.commit()
-    await db.refresh(db_user)
-    return db_user
+    # Drop cached lookups (e.g. the "email not registered" miss from the signup check)
+    _user_cache(db).clear()
+    return User(id=row.id, email=email, hashed_password=hashed_password, created_at=row.created_at)
 
-async def get_user_sessions(db: AsyncSession, user_id: int) -> List[ChatSession]:
-    result = await db.execute(
-        select(ChatSession)
-        .where(ChatSession.user_id == user_id)
-        .order_by(ChatSession.last_updated_at.desc())
-    )
-    return result.scalars().all()
+async def get_user_sessions(db: AsyncSession, user_id: int) -> List[Row]:
+    """Column-only listing: returns (id, title, last_updated_at) rows instead of ORM objects."""
+    rows = _sessions_cache.get(user_id)
+    if rows is None:
+        result = await db.execute(_SEL_USER_SESSIONS, {"user_id": user_id})
+        rows = _sessions_cache[user_id] = result.all()
+    return rows
 
-async def get_session_by_id(db: AsyncSession, session_id: str, user_id: int) -> Optional[ChatSession]:
-     # Ensure user owns the session
-    result = await db.execute(
-        select(ChatSession)
-        .where(ChatSession.id == session_id, ChatSession.user_id == user_id)
-        .options(selectinload(ChatSession.messages)) # Eager load messages
-    )
+async def get_session_meta(db: AsyncSession, session_id: str, user_id: int) -> Optional[str]:
+    """Ownership/existence check: returns the session id if the user owns it, without loading the session or its messages."""
+    result = await db.execute(_SEL_SESSION_META, {"session_id": session_id, "user_id": user_id})
     return result.scalar_one_or_none()
 
+async def get_session_info(db: AsyncSession, session_id: str, user_id: int) -> Optional[Row]:
+    """(id, title, last_updated_at) of a session the user owns; messages are fetched page by page."""
+    result = await db.execute(_SEL_SESSION_INFO, {"session_id": session_id, "user_id": user_id})
+    return result.one_or_none()
+
+async def get_session_messages(db: AsyncSession, session_id: str, before_id: Optional[int] = None,
+                               limit: int = MESSAGE_PAGE_SIZE) -> Tuple[List[Row], bool]:
+    """
+    Keyset page of a session's messages: the `limit` newest messages with id < before_id (or the newest
+    overall), returned oldest first, plus whether older ones exist. No OFFSET scan, no ORM objects.
+    """
+    stmt = (
+        select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.timestamp)
+        .where(ChatMessage.session_id == session_id)
+        .order_by(ChatMessage.id.desc())
+        .limit(limit + 1) # One extra row tells whether there is another page
+    )
+    if before_id is not None:
+        stmt = stmt.where(ChatMessage.id < before_id)
+    rows = (await db.execute(stmt)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+# --- In-flight coalescing for session detail loads ---
+# Rapid re-clicks / reconnects ask for the same session concurrently: the first caller runs the
+# queries, the others await its result (Rows are immutable, so sharing them is safe).
+SessionDetailResult = Tuple[Optional[Row], List[Row], bool]
+_inflight_details: Dict[Tuple[str, int], asyncio.Future] = {}
+
+async def _load_session_detail(db: AsyncSession, session_id: str, user_id: int) -> SessionDetailResult:
+    info = await get_session_info(db, session_id=session_id, user_id=user_id)
+    if info is None:
+        return None, [], False
+    rows, has_more = await get_session_messages(db, session_id=session_id)
+    return info, rows, has_more
+
+async def get_session_detail(db: AsyncSession, session_id: str, user_id: int) -> SessionDetailResult:
+    """(info, newest message page, has_more) for a session the user owns; info is None if not found."""
+    key = (session_id, user_id)
+    pending = _inflight_details.get(key)
+    if pending is not None:
+        try:
+            return await asyncio.shield(pending) # Our own cancellation must not cancel the shared load
+        except asyncio.CancelledError:
+            if not pending.cancelled(): raise
+            # The leading request was cancelled mid-load; load it ourselves below
+        return await _load_session_detail(db, session_id, user_id)
+
+    future = asyncio.get_running_loop().create_future()
+    future.add_done_callback(lambda f: f.cancelled() or f.exception()) # Nobody waiting is fine
+    _inflight_details[key] = future
+    try:
+        result = await _load_session_detail(db, session_id, user_id)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        _inflight_details.pop(key, None)
+
+async def get_session_history(db: AsyncSession, session_id: str, limit: int) -> List[Tuple[str, str]]:
+    """Returns the session's last `limit` messages as (role, content) tuples in chronological order (no ORM objects)."""
+    result = await db.execute(_SEL_SESSION_HISTORY, {"session_id": session_id, "limit": limit})
+    rows = result.all()
+    rows.reverse()
+    return [(role, content) for role, content in rows]
+
 
 async def create_chat_session(db: AsyncSession, user_id: int, title: Optional[str] = None) -> ChatSession:
     session_id = str(uuid.uuid4())
-    db_session = ChatSession(id=session_id, user_id=user_id, title=title)
-    db.add(db_session)
-    # Flush to get the object associated with the session for refresh
-    await db.flush([db_session])
-    # Refresh to load defaults (like created_at) before returning
-    await db.refresh(db_session)
-    # REMOVE EXPLICIT COMMIT - Let the caller handle it
-    # await db.commit() # <-- REMOVE THIS LINE
-    return db_session
-
-async def add_chat_message(db: AsyncSession, session_id: str, role: str, content: str) -> ChatMessage:
-    """Adds a message and updates session timestamp."""
-    # Update session timestamp
+    # Database clock (now()), like add_chat_message, so session and message timestamps stay comparable
     stmt = (
-         update(ChatSession)
-         .where(ChatSession.id == session_id)
-         .values(last_updated_at=func.now())
-     )
-    await db.execute(stmt)
-    # Add message
-    db_message = ChatMessage(session_id=session_id, role=role, content=content)
-    db.add(db_message)
-    # Flush and Refresh 
-    await db.flush([db_message])
+        insert(ChatSession)
+        .values(id=session_id, user_id=user_id, title=title, created_at=func.now(), last_updated_at=func.now())
+        .returning(ChatSession.created_at, ChatSession.last_updated_at)
+    )
+    row = (await db.execute(stmt)).one()
+    _invalidate_user_sessions_on_commit(db, user_id)
+    # No commit here - the caller owns the transaction
+    return ChatSession(id=session_id, user_id=user_id, title=title, created_at=row.created_at, last_updated_at=row.last_updated_at)
 
-    await db.refresh(db_message)
+async def add_chat_message(db: AsyncSession, session_id: str, user_id: int, role: str, content: str) -> ChatMessage:
+    """Adds a message and updates session timestamp in one statement (caller holds the transaction)."""
+    # Session timestamp bump rides along as a data-modifying CTE:
+    # WITH touched AS (UPDATE chat_sessions ...) INSERT INTO chat_messages ... RETURNING id, timestamp
+    touch_session = (
+        update(ChatSession)
+        .where(ChatSession.id == session_id)
+        .values(last_updated_at=func.now())
+        .returning(ChatSession.id)
+        .cte("touched_session")
+    )
+    stmt = (
+        insert(ChatMessage)
+        # Same clock as the session bump (and create_chat_session); ties within one transaction fall back to id
+        .values(session_id=session_id, role=role, content=content, timestamp=func.now())
+        .returning(ChatMessage.id, ChatMessage.timestamp)
+        .add_cte(touch_session)
+    )
+    row = (await db.execute(stmt)).one()
+    _invalidate_user_sessions_on_commit(db, user_id) # last_updated_at (list order) changed
+    # Detached instance for the caller; not tracked by the session
+    return ChatMessage(id=row.id, session_id=session_id, role=role, content=content, timestamp=row.timestamp)
 
-    return db_message
+async def set_chat_message_content(db: AsyncSession, message_id: int, content: str):
+    """Overwrites a message's content (periodic saves of a streamed response); caller holds the transaction."""
+    await db.execute(
+        update(ChatMessage)
+        .where(ChatMessage.id == message_id)
+        .values(content=content)
+    )
+
+async def delete_chat_message(db: AsyncSession, message_id: int):
+    """Deletes a single message; caller holds the transaction."""
+    await db.execute(delete(ChatMessage).where(ChatMessage.id == message_id))
 
 async def delete_chat_session(db: AsyncSession, session_id: str, user_id: int):
     """
-    Deletes a specific chat session and its related messages using ORM cascade.
-    Ensures the user owns the session before deleting.
+    Deletes a specific chat session; its messages go via ON DELETE CASCADE.
+    Ownership check and delete are one statement (DELETE ... WHERE id AND user_id RETURNING id).
     Returns True if deleted, False if not found or not owned.
     """
-    # 1. Fetch the session object first, ensuring ownership
-    stmt = select(ChatSession).where(ChatSession.id == session_id, ChatSession.user_id == user_id)
-    result = await db.execute(stmt)
-    session_to_delete = result.scalar_one_or_none()
-
-    if session_to_delete:
-
-        await db.delete(session_to_delete)
-        # --- Commit the deletion of the session and cascaded messages ---
-        await db.commit() 
-        print(f"CRUD: Deleted session {session_id} and its messages via ORM cascade.")
-        # Indicate success
-        return True
-    else:
+    stmt = (
+        delete(ChatSession)
+        .where(ChatSession.id == session_id, ChatSession.user_id == user_id)
+        .returning(ChatSession.id)
+        .execution_options(synchronize_session=False)
+    )
+    deleted_id = (await db.execute(stmt)).scalar_one_or_none()
+    await db.commit()
+    invalidate_user_sessions(user_id)
+    if deleted_id is None:
         # Session not found or doesn't belong to the user
-        print(f"CRUD: Session {session_id} not found for user {user_id} or already deleted.")
-        # Indicate session not found/deleted
-        return False 
+        logger.debug("Session %s not found for user %s or already deleted.", session_id, user_id)
+        return False
+    logger.debug("Deleted session %s and its messages.", session_id)
+    return True
+
+DELETE_BATCH_SIZE = 500
 
 async def delete_all_user_sessions(db: AsyncSession, user_id: int):
     """
-    Deletes all chat sessions for a user using ORM cascade for messages.
+    Deletes all chat sessions for a user in batches of DELETE_BATCH_SIZE, one commit per batch, so
+    lock time and WAL per transaction stay bounded for users with many sessions. Messages go via ON DELETE CASCADE.
     """
-    # --- Fetch all session objects for the user ---
-    stmt = select(ChatSession).where(ChatSession.user_id == user_id)
-    result = await db.execute(stmt)
-    sessions_to_delete = result.scalars().all()
-
-    if sessions_to_delete:
-        print(f"CRUD: Deleting {len(sessions_to_delete)} sessions for user {user_id} via ORM cascade...")
-        for session in sessions_to_delete:
-            await db.delete(session) # Delete each session object
-        await db.commit() # Commit all deletions
-        print(f"CRUD: Finished deleting sessions for user {user_id}.")
+    batch_ids = (
+        select(ChatSession.id)
+        .where(ChatSession.user_id == user_id)
+        .limit(DELETE_BATCH_SIZE)
+        .scalar_subquery()
+    )
+    stmt = (
+        delete(ChatSession)
+        .where(ChatSession.id.in_(batch_ids))
+        .returning(ChatSession.id)
+        .execution_options(synchronize_session=False)
+    )
+    total_deleted = 0
+    try:
+        while True:
+            deleted_ids = (await db.execute(stmt)).scalars().all()
+            await db.commit()
+            total_deleted += len(deleted_ids)
+            if len(deleted_ids) < DELETE_BATCH_SIZE:
+                break
+    finally:
+        invalidate_user_sessions(user_id) # Earlier batches may be committed even if a later one failed
+    if total_deleted:
+        logger.debug("Deleted %s sessions for user %s.", total_deleted, user_id)
     else:
-        print(f"CRUD: No sessions found to delete for user {user_id}.")
\ No newline at end of file
+        logger.debug("No sessions found to delete for user %s.", user_id)
@@ -0,0 +1,52 @@
+# file: Backend/services/stream_store.py
+import asyncio
+import os
+import orjson
+from dotenv import load_dotenv
+from typing import Dict, Optional
+
+# Redis is optional: without REDIS_URL (or the package) contexts live in-process with an expiry task
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL")
+STREAM_TTL_SECONDS = 120
+KEY_PREFIX = "stream:"
+
+_redis = redis_asyncio.from_url(REDIS_URL) if REDIS_URL and redis_asyncio else None
+
+# --- In-process fallback (single worker / development) ---
+_local_contexts: Dict[str, bytes] = {}
+_expiry_tasks: Dict[str, asyncio.Task] = {}
+
+
+async def _expire(stream_id: str, ttl: int):
+    await asyncio.sleep(ttl)
+    if _local_contexts.pop(stream_id, None) is not None:
+        print(f"StreamStore: Context for stream {stream_id} expired unused.")
+    _expiry_tasks.pop(stream_id, None)
+
+
+async def put_context(stream_id: str, context: Dict, ttl: int = STREAM_TTL_SECONDS):
+    """Stores the stream context (history, session_id, user_id) until it is consumed or expires."""
+    payload = orjson.dumps(context)
+    if _redis is not None:
+        await _redis.set(KEY_PREFIX + stream_id, payload, ex=ttl)
+        return
+    _local_contexts[stream_id] = payload
+    _expiry_tasks[stream_id] = asyncio.create_task(_expire(stream_id, ttl))
+
+
+async def pop_context(stream_id: str) -> Optional[Dict]:
+    """Atomically takes the context for stream_id; None if unknown, consumed or expired."""
+    if _redis is not None:
+        payload = await _redis.getdel(KEY_PREFIX + stream_id)
+    else:
+        payload = _local_contexts.pop(stream_id, None)
+        task = _expiry_tasks.pop(stream_id, None)
+        if task: task.cancel()
+    return orjson.loads(payload) if payload is not None else None
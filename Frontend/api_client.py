@@ -1,6 +1,9 @@
 # file: frontend/api_client.py
+import asyncio
+import time
 import httpx
-from typing import Optional, List, Dict, Any
+import orjson
+from typing import Optional, List, Dict, Any, Tuple
 import os
 from dotenv import load_dotenv
 
@@ -11,19 +14,82 @@ BACKEND_BASE_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 print(f"---- Using backend URL: ----- {BACKEND_BASE_URL}")
 
 # --- Store cookies globally for the client instance ---
-_client = httpx.AsyncClient(base_url=BACKEND_BASE_URL, timeout=180.0)
+# One process-wide client, created on app startup and closed on shutdown (see startup/shutdown below):
+# keep-alive pool sized for concurrent UI clients; HTTP/2 is negotiated (ALPN) when the backend is
+# served over TLS, plain http:// stays on HTTP/1.1 keep-alive. The SSE stream reuses it too.
+_client: Optional[httpx.AsyncClient] = None
+
+def _create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=BACKEND_BASE_URL,
+        timeout=httpx.Timeout(180.0, connect=5.0), # Fail fast if the backend is down
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=200, keepalive_expiry=30),
+    )
+
+# --- Endpoint URLs (parsed once; all relative to base_url, no leading slash) ---
+_URL_LOGIN = httpx.URL("api/login")
+_URL_SIGNUP = httpx.URL("api/signup")
+_URL_LOGOUT = httpx.URL("api/logout")
+_URL_USERS_ME = httpx.URL("api/users/me")
+_URL_SESSIONS = httpx.URL("api/sessions")
+_URL_CHAT_INITIATE = httpx.URL("api/chat/initiate")
+
+# Read size when streaming session details
+SESSION_DETAILS_CHUNK_SIZE = 65536
+
+# --- JSON (orjson both ways) ---
+_JSON_HEADERS = {"content-type": "application/json"}
+
+def _dumps(payload: Any) -> bytes:
+    return orjson.dumps(payload)
+
+def _loads(response: httpx.Response) -> Any:
+    return orjson.loads(response.content)
+
+# Backend SessionMiddleware cookie (Starlette default name); without it every authenticated call is a 401
+SESSION_COOKIE_NAME = "session"
+
+def _session_cookie() -> Optional[str]:
+    for cookie in _client.cookies.jar:
+        if cookie.name == SESSION_COOKIE_NAME: return cookie.value
+    return None
+
+def _has_session_cookie() -> bool:
+    """Local check only: an expired/invalid cookie still goes to the backend and gets its 401 there."""
+    return _session_cookie() is not None
+
+# --- Current user cache ---
+# Page handlers each ask "who is logged in?" (/ -> /login -> /main within a second). The answer is
+# reused for a few seconds, keyed by the session cookie value: login/logout change the cookie, so
+# they invalidate it by construction.
+CURRENT_USER_TTL_SECONDS = 10.0
+_current_user_cache: Optional[Tuple[str, float, Optional[Dict[str, Any]]]] = None # (cookie, time, user)
+
+async def startup():
+    """Creates the shared client on the app's event loop (registered as an app startup handler)."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _create_client()
+
+async def shutdown():
+    """Closes the shared client (registered as an app shutdown handler)."""
+    if _client is not None:
+        await _client.aclose()
 
 async def api_login(email: str, password: str) -> Optional[Dict[str, Any]]:
     """Calls the backend login API."""
     try:
-        response = await _client.post("api/login", json={"email": email, "password": password})
+        response = await _client.post(_URL_LOGIN, content=_dumps({"email": email, "password": password}), headers=_JSON_HEADERS)
         response.raise_for_status() # Raise exception for 4xx/5xx errors
 
         # Login success sets a cookie automatically handled by httpx client instance
-        return response.json() # Return user info or success message
+        return _loads(response) # Return user info or success message
     
     except httpx.HTTPStatusError as e:
         print(f"Login API error: {e.response.status_code} - {e.response.text}")
+        if e.response.status_code == 429:
+            return {"error": "Too many login attempts. Try again in a minute."}
         return None # Indicate login failure
     
     except Exception as e:
@@ -33,9 +99,9 @@ async def api_login(email: str, password: str) -> Optional[Dict[str, Any]]:
 async def api_signup(email: str, password: str) -> Optional[Dict[str, Any]]:
     """Calls the backend signup API."""
     try:
-        response = await _client.post("api/signup", json={"email": email, "password": password})
+        response = await _client.post(_URL_SIGNUP, content=_dumps({"email": email, "password": password}), headers=_JSON_HEADERS)
         response.raise_for_status()
-        return response.json() # Return created user info
+        return _loads(response) # Return created user info
     
     except httpx.HTTPStatusError as e:
         print(f"Signup API error: {e.response.status_code} - {e.response.text}")
@@ -43,7 +109,7 @@ async def api_signup(email: str, password: str) -> Optional[Dict[str, Any]]:
         detail = "Signup failed."
 
         try:
-            detail = e.response.json().get("detail", detail)
+            detail = _loads(e.response).get("detail", detail)
         except Exception: pass
         raise ValueError(detail) 
     
@@ -54,11 +120,13 @@ async def api_signup(email: str, password: str) -> Optional[Dict[str, Any]]:
 
 async def api_logout() -> bool:
     """Calls the backend logout API."""
+    global _current_user_cache
     try:
-        response = await _client.post("/api/logout") 
+        response = await _client.post(_URL_LOGOUT) 
         response.raise_for_status()
         # Clear local cookies managed by the client instance
         _client.cookies.clear()
+        _current_user_cache = None
         return True
     
     except Exception as e:
@@ -67,13 +135,25 @@ async def api_logout() -> bool:
 
 
 async def api_get_current_user() -> Optional[Dict[str, Any]]:
-    """Calls the backend /api/users/me endpoint."""
+    """Calls the backend /api/users/me endpoint (answer reused for CURRENT_USER_TTL_SECONDS)."""
+    global _current_user_cache
+    session_cookie = _session_cookie()
+    if session_cookie is None: # Anonymous: skip the round trip that can only return 401
+        return None
+    now = time.monotonic()
+    if _current_user_cache is not None:
+        cached_cookie, cached_at, cached_user = _current_user_cache
+        if cached_cookie == session_cookie and now - cached_at < CURRENT_USER_TTL_SECONDS:
+            return cached_user
     try:
-        response = await _client.get("api/users/me")
+        response = await _client.get(_URL_USERS_ME)
         if response.status_code == 401: # Handle unauthorized
+            _current_user_cache = (session_cookie, now, None)
             return None
         response.raise_for_status()
-        return response.json()
+        user = _loads(response)
+        _current_user_cache = (session_cookie, now, user)
+        return user
     
     except httpx.HTTPStatusError as e:
          print(f"Get current user API error: {e.response.status_code} - {e.response.text}")
@@ -85,35 +165,56 @@ async def api_get_current_user() -> Optional[Dict[str, Any]]:
 
 async def api_get_sessions() -> List[Dict[str, Any]]:
     """Calls the backend to get user's sessions."""
+    if not _has_session_cookie():
+        return []
     try:
-        response = await _client.get("api/sessions")
-        if response.status_code == 401: return [] # Not logged in
-        response.raise_for_status()
-        return response.json()
+        response = await _client.get(_URL_SESSIONS)
+        # Expected 4xx (e.g. 401 not logged in) is a plain return, no exception; only 5xx raises
+        if response.status_code >= 500: response.raise_for_status()
+        return _loads(response) if response.status_code < 400 else []
     
     except Exception as e:
         print(f"Get sessions error: {e}")
         return []
 
+async def api_bootstrap() -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Fetches the current user and their sessions concurrently (page load)."""
+    user, sessions = await asyncio.gather(api_get_current_user(), api_get_sessions())
+    return user, sessions
+
 async def api_get_session_details(session_id: str) -> Optional[Dict[str, Any]]:
      """Calls backend to get messages for a session."""
      try:
-         response = await _client.get(f"api/sessions/{session_id}")
-         if response.status_code == 401: return None
-         if response.status_code == 404: return None
-         response.raise_for_status()
-         return response.json()
+         # Stream the (possibly long) history into one preallocated-growth buffer and parse once
+         async with _client.stream("GET", f"api/sessions/{session_id}") as response:
+             if response.status_code >= 500:
+                 await response.aread()
+                 response.raise_for_status()
+             if response.status_code >= 400: return None # 401/404 -> None
+             body = bytearray()
+             async for chunk in response.aiter_bytes(SESSION_DETAILS_CHUNK_SIZE):
+                 body += chunk
+         return orjson.loads(body)
      except Exception as e:
          print(f"Get session details error for {session_id}: {e}")
          return None
 
+async def api_get_session_messages(session_id: str, before_id: int) -> Optional[Dict[str, Any]]:
+    """Calls backend for the page of messages older than before_id: {messages, has_more}."""
+    try:
+        response = await _client.get(f"api/sessions/{session_id}/messages", params={"before": before_id})
+        if response.status_code >= 500: response.raise_for_status()
+        return _loads(response) if response.status_code < 400 else None
+    except Exception as e:
+        print(f"Get session messages error for {session_id}: {e}")
+        return None
+
 async def api_delete_session(session_id: str) -> bool:
     """Calls backend to delete a session."""
     try:
         response = await _client.delete(f"api/sessions/{session_id}")
-        if response.status_code == 401: return False
-        response.raise_for_status() 
-        return response.status_code == 204 # Success is No Content
+        if response.status_code >= 500: response.raise_for_status()
+        return response.status_code == 204 # Success is No Content; 401/404 -> False
     
     except Exception as e:
         print(f"Delete session error for {session_id}: {e}")
@@ -124,11 +225,11 @@ async def api_initiate_chat(session_id: Optional[str], user_message: str) -> Opt
      try:
          payload = {"session_id": session_id, "user_message": user_message}
 
-         response = await _client.post("/api/chat/initiate", json=payload)
+         response = await _client.post(_URL_CHAT_INITIATE, content=_dumps(payload), headers=_JSON_HEADERS)
 
          if response.status_code == 401: return None
          response.raise_for_status()
-         return response.json() # Returns {session_id, user_message_id, stream_id}
+         return _loads(response) # Returns {session_id, user_message_id, stream_id}
      
      except Exception as e:
          print(f"Initiate chat error: {e}")
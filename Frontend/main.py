@@ -31,6 +31,14 @@ async def main_chat_page(client: Client):
 
 # --- init_nicegui ---
 def init_nicegui(fastapi_app: FastAPI):
+     # run.py can be imported twice in one process ("__main__" and "run"); mount only once per app
+     if getattr(fastapi_app.state, "nicegui_mounted", False):
+          return
+     fastapi_app.state.nicegui_mounted = True
+     # The shared httpx client (API calls and SSE) lives on the app's loop: created at startup, closed at shutdown
+     app.on_startup(api_client.startup)
+     app.on_shutdown(api_client.shutdown)
+     main.add_shared_head_html()
      ui.run_with(
          fastapi_app,
          mount_path="/",
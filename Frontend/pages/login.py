@@ -1,5 +1,6 @@
 from nicegui import ui, app, Client
 from .. import api_client
+from .. import utils
 from ..pageRoutes import pageRoutes
 
 
@@ -49,9 +50,10 @@ async def handle_login(client: Client):
             if not email or not password: error_label.set_text("Enter email/password."); return
             user_info = await api_client.api_login(email, password)
             if user_info and user_info.get("user_id"):
-                if "chat" in client.storage: del client.storage["chat"]
+                utils.reset_chat_state(client)
                 print(f"UI: Logged in: {user_info.get('email')}")
                 ui.navigate.to(pageRoutes.MAIN_PATH)
+            elif user_info and user_info.get("error"): error_label.set_text(user_info["error"])
             else: error_label.set_text("Invalid email or password.")
 
         ui.button("Login", on_click=handle_login_click, color='#40040b').classes('w-full mt-4')
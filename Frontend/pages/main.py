@@ -1,9 +1,12 @@
 import html
 import traceback
+import orjson
 from nicegui import ui, app, Client
-from typing import Optional, Dict
+from typing import Coroutine, Optional, Dict, List, Set
 import datetime
 import asyncio
+import functools
+import itertools
 
 from .. import api_client
 from .. import sse_client
@@ -11,57 +14,329 @@ from ..pageRoutes import pageRoutes
 from .. import utils
 
 # --- Constants ---
-ASSISTANT_PLACEHOLDER_ID_PREFIX = "assist_placeholder_"
-
+# Client-side ids for messages not (yet) known by their DB id: negative ints, so they never collide
+# with DB ids (positive) and compare as plain ints
+_temp_ids = itertools.count(-1, -1)
+
+def is_db_message_id(message_id) -> bool:
+    return isinstance(message_id, int) and message_id > 0
+# Streamed tokens are batched into one UI refresh per UI_FLUSH_SECONDS or UI_FLUSH_CHARS of new text,
+# but never more than one per UI_MIN_FLUSH_SECONDS (one animation frame), however fast tokens arrive
+UI_FLUSH_SECONDS = 0.05
+UI_FLUSH_CHARS = 32
+UI_MIN_FLUSH_SECONDS = 1 / 60
+# Response text not yet pushed to a disconnected/background tab beyond which the stream is read slower
+MAX_UNSENT_UI_CHARS = 64_000
+SESSION_ROW_CLASSES = 'w-full items-center cursor-pointer p-2 rounded text-sm hover:bg-red-900'
+MESSAGE_PRE_STYLE = "white-space: pre-wrap; word-wrap: break-word; font-family: monospace; margin: 0;"
+
+# ui.html element of the assistant message being streamed, per client id. The stream loop writes
+# into it directly instead of re-rendering the whole message area.
+_stream_html: Dict[str, ui.html] = {}
+# Streams read by the browser (sse_client.BROWSER_STREAM_URL): resolved with {'text', 'error'} when it ends
+_browser_streams: Dict[str, asyncio.Future] = {}
+# Fire-and-forget tasks per client id (run_in_background), kept referenced until done
+_background_tasks: Dict[str, Set[asyncio.Task]] = {}
+
+def render_message_html(escaped_content: str) -> str:
+    return f'<pre style="{MESSAGE_PRE_STYLE}">{escaped_content}</pre>'
+
+
+# Installed once per page: scroll calls then send a one-line call instead of a script body.
+# requestAnimationFrame runs after the browser has applied the refresh, so scrollHeight is final;
+# the pending flag coalesces scrolls requested within one frame into a single one. The column node is
+# looked up once and reused while it is still in the document and has the requested id.
+SCROLL_HELPER_JS = '''
+<script>
+window.scrollChatToBottom = (id) => {
+    if (window.chatScrollPending) return;
+    window.chatScrollPending = true;
+    requestAnimationFrame(() => {
+        window.chatScrollPending = false;
+        let el = window.chatScrollEl;
+        if (!el || !el.isConnected || el.id !== 'c' + id) { el = window.chatScrollEl = getElement(id); }
+        if (el) { el.scrollTop = el.scrollHeight; }
+        else { console.warn('Scroll target element not found:', id); }
+    });
+};
+</script>
+'''
+
+# Installed when the browser reads streams itself: chunks go straight into the streaming message's <pre>
+# and only the final text comes back, as one chat_stream_done event. The backend drops the stream context
+# on first connect, so the source is closed at the first error instead of auto-reconnecting.
+STREAM_HELPER_JS = '''
+<script>
+window.streamChatToElement = (url, id) => {
+    const source = new EventSource(url);
+    let text = '';
+    const finish = (error) => { source.close(); emitEvent('chat_stream_done', {text: text, error: error}); };
+    source.onmessage = (e) => {
+        if (e.data === '[DONE]') return finish(null);
+        text += e.data;
+        document.querySelector('#c' + id + ' pre')?.append(e.data);
+    };
+    source.addEventListener('error', (e) => {
+        if (e.data) { // Server-sent "event: error" frame
+            let message = e.data;
+            try { message = JSON.parse(e.data).error || message; } catch (_) {}
+            return finish(message);
+        }
+        // CLOSED means the connection itself failed (e.g. 404); otherwise the server ended the stream
+        finish(source.readyState === EventSource.CLOSED && !text ? '[ERROR] Connection failed' : null);
+    });
+};
+</script>
+'''
+
+# --- CSS for Dark Scrollbar and scroll anchoring (built once, shared by all pages) ---
+SCROLLBAR_TRACK_COLOR = "#1f2937" # Match your dark page background (e.g., gray-800)
+SCROLLBAR_THUMB_COLOR = "#4b5563" # A slightly lighter dark gray (e.g., gray-600)
+SCROLLBAR_THUMB_HOVER_COLOR = "#6b7280" # Lighter still for hover (e.g., gray-500)
+SCROLLBAR_WIDTH = "8px" # Adjust width as desired (e.g., 6px, 10px)
+
+CHAT_PAGE_CSS = f'''
+<style>
+/* Target the specific messages column */
+.messages-column-scrollbar::-webkit-scrollbar {{
+width: {SCROLLBAR_WIDTH};
+height: {SCROLLBAR_WIDTH}; /* For horizontal scrollbars if ever needed */
+}}
+
+/* Track */
+.messages-column-scrollbar::-webkit-scrollbar-track {{
+background: {SCROLLBAR_TRACK_COLOR};
+border-radius: {SCROLLBAR_WIDTH}; /* Round the track ends */
+}}
+
+/* Handle */
+.messages-column-scrollbar::-webkit-scrollbar-thumb {{
+background-color: {SCROLLBAR_THUMB_COLOR};
+border-radius: {SCROLLBAR_WIDTH};
+/* Add a border matching the track for a 'padding' effect */
+/* border: 2px solid {SCROLLBAR_TRACK_COLOR}; */
+}}
+
+/* Handle on hover */
+.messages-column-scrollbar::-webkit-scrollbar-thumb:hover {{
+background-color: {SCROLLBAR_THUMB_HOVER_COLOR};
+}}
+
+/* Scroll anchoring: only the bottom sentinel may anchor, so growing content keeps the view pinned to the bottom */
+.messages-column-scrollbar > * {{
+overflow-anchor: none;
+}}
+.messages-column-scrollbar > .chat-scroll-anchor {{
+overflow-anchor: auto;
+height: 1px;
+flex-shrink: 0;
+}}
+
+/* Firefox Scrollbar Styling */
+.messages-column-scrollbar {{
+scrollbar-width: thin; /* Or 'auto' */
+scrollbar-color: {SCROLLBAR_THUMB_COLOR} {SCROLLBAR_TRACK_COLOR}; /* thumb track */
+}}
+</style>
+'''
+
+def add_shared_head_html():
+    """Registers the chat page's CSS and JS helpers once, at app setup, instead of on every page load."""
+    ui.add_head_html(CHAT_PAGE_CSS, shared=True)
+    ui.add_head_html(SCROLL_HELPER_JS, shared=True)
+    if sse_client.BROWSER_STREAM_URL:
+        ui.add_head_html(STREAM_HELPER_JS, shared=True)
 
 # --- Standalone Async Helper Functions ---
-async def scroll_chat_to_bottom(client: Client, messages_column_id: Optional[int]):
-    """Scrolls the specified messages column to the bottom."""
+def scroll_chat_to_bottom(client: Client, messages_column_id: Optional[int]):
+    """Scrolls the specified messages column to the bottom (fire-and-forget, no reply awaited)."""
     chat_state = utils.get_chat_state(client)
-    if not chat_state.get('current_messages') or not messages_column_id: return
-    await asyncio.sleep(0.15) # Delay for rendering
-    # Use the client to run JavaScript to scroll the element
-    await client.run_javascript(f'''
-        const el = getElement({messages_column_id});
-        if (el) {{ el.scrollTop = el.scrollHeight; }}
-        else {{ console.warn('Scroll target element not found:', {messages_column_id}); }}
-    ''')
+    if not chat_state.current_messages or not messages_column_id: return
+    client.run_javascript(f'scrollChatToBottom({messages_column_id})') # Helper installed with the page (SCROLL_HELPER_JS)
+
+@functools.lru_cache(maxsize=4096)
+def _format_session_time(ts_str: str) -> str:
+    """ISO timestamp -> "Mon DD, HH:MM"; memoized, since the same strings come back on every fetch."""
+    try:
+        if ts_str.endswith('Z'): ts_str = ts_str[:-1] + '+00:00'
+        return datetime.datetime.fromisoformat(ts_str).strftime("%b %d, %H:%M")
+    except ValueError: return ts_str
+
+def touch_session_locally(client: Client, session_id: str) -> bool:
+    """
+    Moves a session to the top of sessions_list with a fresh timestamp, mirroring what the server did
+    when a message was added, without re-fetching the list. False if the session is not in the list.
+    """
+    sessions = utils.get_chat_state(client).sessions_list
+    for i, session_data in enumerate(sessions):
+        if session_data.get('id') == session_id:
+            sessions.insert(0, sessions.pop(i))
+            session_data['last_updated_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            prepare_sessions([session_data])
+            return True
+    return False
+
+def add_session_locally(client: Client, session_id: str, title: Optional[str]):
+    """Puts a just-created session on top of sessions_list, as the server lists it, without re-fetching the list."""
+    session_data = {'id': session_id, 'title': title,
+                    'last_updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    utils.get_chat_state(client).sessions_list.insert(0, prepare_sessions([session_data])[0])
+
+def prepare_sessions(sessions: list) -> list:
+    """Adds '_display_time' to each session at ingest, so rendering never parses timestamps."""
+    for session_data in sessions:
+        ts_str = session_data.get('last_updated_at')
+        session_data['_display_time'] = _format_session_time(ts_str) if isinstance(ts_str, str) else "..."
+    return sessions
+
+# --- Sessions list fetch: single-flight per client + short freshness window ---
+SESSIONS_FRESH_SECONDS = 2.0
+_sessions_inflight: Dict[str, asyncio.Task] = {}
+_sessions_fetched_at: Dict[str, float] = {} # client id -> loop time of the last completed fetch
+
+def invalidate_sessions(client: Client):
+    """Forces the next update_sessions_list to fetch (after a send, delete or new session)."""
+    _sessions_fetched_at.pop(client.id, None)
+
+def run_in_background(client: Client, coro: Coroutine) -> None:
+    """Runs UI work nobody has to wait for (e.g. a list re-fetch) in the client's context; cancelled on disconnect."""
+    async def run():
+        with client:
+            await coro
+    task = asyncio.create_task(run())
+    tasks = _background_tasks.setdefault(client.id, set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+def _forget_client(client: Client):
+    """Drops per-client module state when the browser disconnects."""
+    for task in _background_tasks.pop(client.id, ()):
+        task.cancel()
+    _sessions_fetched_at.pop(client.id, None)
+    _stream_html.pop(client.id, None)
+    _finish_browser_stream(client, {'text': '', 'error': '[ERROR] Browser disconnected'})
+
+def _finish_browser_stream(client: Client, result: Dict):
+    future = _browser_streams.get(client.id)
+    if future is not None and not future.done():
+        future.set_result(result)
+
+async def _stream_in_browser(client: Client, url: str, html_id: int) -> Dict:
+    """Has the browser read the stream (STREAM_HELPER_JS) into the given ui.html; returns {'text', 'error'} once it ends."""
+    future = _browser_streams[client.id] = asyncio.get_running_loop().create_future()
+    try:
+        client.run_javascript(f'streamChatToElement({orjson.dumps(url).decode()}, {html_id})')
+        return await future
+    finally:
+        _browser_streams.pop(client.id, None)
+
+async def _fetch_sessions(client: Client) -> list:
+    try:
+        return await api_client.api_get_sessions()
+    finally:
+        _sessions_inflight.pop(client.id, None)
 
 async def update_sessions_list(client: Client, sessions_container_refresh_func: callable):
-    """Fetches sessions and refreshes the list UI."""
+    """Fetches sessions and refreshes the list UI; concurrent calls share one request."""
+    loop = asyncio.get_running_loop()
     try:
-        sessions = await api_client.api_get_sessions()
+        task = _sessions_inflight.get(client.id)
+        if task is None:
+            fetched_at = _sessions_fetched_at.get(client.id)
+            if fetched_at is not None and loop.time() - fetched_at < SESSIONS_FRESH_SECONDS:
+                return # Nothing changed since a fetch moments ago
+            task = _sessions_inflight[client.id] = asyncio.create_task(_fetch_sessions(client))
+        sessions = prepare_sessions(await asyncio.shield(task))
+        _sessions_fetched_at[client.id] = loop.time()
         print(f"UI Helper: Fetched sessions: {len(sessions)}")
         utils.update_chat_state(client, sessions_list=sessions)
         sessions_container_refresh_func() # Call the passed refresh method
     except Exception as e: print(f"Error updating sessions list: {e}"); ui.notify("Failed history load.", type='negative')
 
-async def update_chat_display(client: Client, chat_messages_area_refresh_func: callable, messages_column_id: Optional[int]):
-    """Refreshes chat messages and schedules scroll."""
-    print("UI Helper: Triggering chat messages refresh.")
-    chat_messages_area_refresh_func() # Call the passed refresh method
-    # Schedule scroll to run after current event handling cycle
-    asyncio.create_task(scroll_chat_to_bottom(client, messages_column_id))
+class BatchedUIUpdate:
+    """
+    Collects a UI update and applies it on exit in levels: all state writes, then each queued refresh
+    once, then at most one scroll. Callers enqueue instead of interleaving write/refresh/scroll.
+    Scrolling is only needed when jumping to the bottom: once there, the CSS scroll anchor keeps it pinned.
+    """
+    def __init__(self, client: Client, messages_column_id: Optional[int] = None):
+        self.client = client
+        self.messages_column_id = messages_column_id
+        self._state_changes: Dict = {}
+        self._message_edits: list = []
+        self._refreshes: list = []
+        self._scroll = False
+
+    def state(self, **kwargs):
+        self._state_changes.update(kwargs)
+
+    def messages(self, fn: callable):
+        """Queues an in-place edit of current_messages (applied with the state writes)."""
+        self._message_edits.append(fn)
+
+    def refresh(self, refresh_func: callable):
+        if refresh_func not in self._refreshes: self._refreshes.append(refresh_func)
+
+    def scroll(self):
+        self._scroll = True
+
+    def __enter__(self) -> "BatchedUIUpdate":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None: return False # Nothing applied on error
+        if self._state_changes: utils.update_chat_state(self.client, **self._state_changes) # Level 0: writes
+        for fn in self._message_edits: utils.mutate_messages(self.client, fn)
+        for refresh_func in self._refreshes: refresh_func() # Level 1: one render pass each
+        if self._scroll: scroll_chat_to_bottom(self.client, self.messages_column_id) # Level 2: one scroll
+        return False
 
 async def select_chat_session(client: Client, session_id: Optional[str], chat_refresh_func: callable, messages_column_id: Optional[int]):
     """Selects a session, fetches messages, updates state and UI."""
     print(f"UI Helper: Selecting session: {session_id}")
     messages = []
+    has_more = False
     title = "New Chat"
     loaded_session_id = None # Track the ID actually loaded
     if session_id:
         session_details = await api_client.api_get_session_details(session_id)
         if session_details and 'messages' in session_details:
-            messages = [{'id': msg.get('id'), 'role': msg.get('role'), 'content': msg.get('content')}
-                        for msg in session_details['messages']]
+            # Only the newest page; older messages load on demand (load_earlier_messages).
+            # The dicts are freshly parsed and already have id/role/content: used as they are
+            messages = session_details['messages']
+            has_more = session_details.get('has_more', False)
             title = session_details.get('title') or f"Chat {session_id[:8]}..."
             loaded_session_id = session_id # Confirm this session was loaded
         else:
             ui.notify("Could not load session details.", type='negative')
 
-    # Update state using helper
-    utils.update_chat_state(client, current_session_id=loaded_session_id, current_messages=messages, current_title=title)
-    await update_chat_display(client, chat_refresh_func, messages_column_id)
+    with BatchedUIUpdate(client, messages_column_id) as batch:
+        batch.state(current_session_id=loaded_session_id, current_messages=messages,
+                    has_more_messages=has_more, current_title=title)
+        batch.refresh(chat_refresh_func)
+        batch.scroll()
+
+async def load_earlier_messages(client: Client, chat_refresh_func: callable, history_prepend_func: Optional[callable] = None):
+    """
+    Prepends the next older page of messages for the current session (keyset on the oldest loaded id).
+    With history_prepend_func only the new page is rendered; the full refresh is the fallback.
+    """
+    chat_state = utils.get_chat_state(client)
+    session_id = chat_state.current_session_id
+    messages = chat_state.current_messages
+    if not session_id or not messages or not is_db_message_id(messages[0].get('id')): return
+    page = await api_client.api_get_session_messages(session_id, before_id=messages[0]['id'])
+    if page is None:
+        ui.notify("Could not load earlier messages.", type='negative'); return
+    if chat_state.current_messages is not messages: return # Another session was selected meanwhile
+    older = page.get('messages', []) # Freshly parsed dicts, used as they are
+    messages[:0] = older # In place; the list is the state's own
+    utils.update_chat_state(client, has_more_messages=page.get('has_more', False))
+    # No scroll: the user is reading at the top
+    if history_prepend_func:
+        history_prepend_func(older, chat_state.has_more_messages)
+    else:
+        chat_refresh_func()
 
 async def delete_chat_session(client: Client, session_id: str, sessions_refresh_func: callable, chat_refresh_func: callable, messages_column_id: Optional[int]):
     """Deletes a session, updates state and UI."""
@@ -70,35 +345,51 @@ async def delete_chat_session(client: Client, session_id: str, sessions_refresh_
         ui.notify(f"Session deleted.", type='positive')
         chat_state = utils.get_chat_state(client) # Get current state
         # Check if the deleted session was the active one
-        if chat_state.get("current_session_id") == session_id:
+        if chat_state.current_session_id == session_id:
             # Select "New Chat" state by calling select_chat_session with None
             await select_chat_session(client, None, chat_refresh_func, messages_column_id)
         # Always refresh the session list
+        invalidate_sessions(client)
         await update_sessions_list(client, sessions_refresh_func)
     else:
         ui.notify("Error deleting session.", type='negative')
 
-async def handle_send_message(client: Client, chat_input: ui.input, send_button: ui.button, chat_refresh_func: callable, sessions_refresh_func: callable, messages_column_id: Optional[int]):
-    """Handles sending message, API calls, streaming, state, and UI updates."""
+async def handle_send_message(client: Client, chat_input: ui.input, send_button: ui.button, chat_refresh_func: callable, sessions_refresh_func: callable, messages_column_id: Optional[int],
+                              tail_refresh_func: Optional[callable] = None, history_append_func: Optional[callable] = None):
+    """
+    Handles sending message, API calls, streaming, state, and UI updates. With tail_refresh_func and
+    history_append_func the rendered history is only appended to; the full refresh is the fallback.
+    """
     chat_state = utils.get_chat_state(client) # Get current state
     user_input = chat_input.value
-    if not user_input or chat_state.get("is_generating"): return
+    if not user_input or chat_state.is_generating: return
     chat_input.set_value(None) # Clear input
 
-    current_session_id = chat_state.get("current_session_id")
+    current_session_id = chat_state.current_session_id
     print(f"UI Helper: Sending '{user_input}' for session: {current_session_id}")
 
     # 1. Prepare message objects & Update UI Immediately
-    temp_user_msg_id = f"user_{datetime.datetime.now().timestamp()}"
-    user_message = {"role": "user", "content": user_input, "id": temp_user_msg_id}
-    temp_assist_msg_id = f"{ASSISTANT_PLACEHOLDER_ID_PREFIX}{datetime.datetime.now().timestamp()}"
-    assistant_placeholder = {"role": "assistant", "content": "", "id": temp_assist_msg_id}
-
-    # --- Explicit State Update ---
-    new_messages_list = chat_state["current_messages"] + [user_message, assistant_placeholder]
-    utils.update_chat_state(client, current_messages=new_messages_list.copy(), is_generating=True) # Use copy
+    # Both dicts are edited in place from here on (only this coroutine streams for this client)
+    user_message = {"role": "user", "content": user_input, "id": next(_temp_ids)}
+    assistant_placeholder = {"role": "assistant", "content": "", "id": next(_temp_ids), "_streaming": True}
+
+    def drop_placeholder(messages: list):
+        messages[:] = [m for m in messages if m is not assistant_placeholder]
+
+    previous_last = chat_state.current_messages[-1] if chat_state.current_messages else None
+    appended_elements: list = [] # Elements appended to the rendered history by this send
+    with BatchedUIUpdate(client, messages_column_id) as batch:
+        batch.messages(lambda messages: messages.extend((user_message, assistant_placeholder)))
+        batch.state(is_generating=True)
+        if previous_last is not None and tail_refresh_func and history_append_func:
+            # The old last message (from the tail) and the user message join the rendered history;
+            # the tail re-renders with the placeholder. Nothing else is rebuilt.
+            batch.refresh(lambda: appended_elements.extend(history_append_func([previous_last, user_message])))
+            batch.refresh(tail_refresh_func)
+        else:
+            batch.refresh(chat_refresh_func) # Empty chat: the empty-state view has to go
+        batch.scroll()
     send_button.props('loading').classes('animate-pulse')
-    await update_chat_display(client, chat_refresh_func, messages_column_id) # Refresh UI
 
     # 2. Call API
     init_response = await api_client.api_initiate_chat(current_session_id, user_input)
@@ -106,10 +397,17 @@ async def handle_send_message(client: Client, chat_input: ui.input, send_button:
     # 3. Handle API Failure
     if not init_response or "stream_id" not in init_response:
         ui.notify("Error starting chat.", type='negative')
-        final_messages = [m for m in utils.get_chat_state(client)["current_messages"] if m.get('id') != temp_assist_msg_id]
-        utils.update_chat_state(client, current_messages=final_messages, is_generating=False)
+        with BatchedUIUpdate(client, messages_column_id) as batch:
+            batch.messages(drop_placeholder)
+            batch.state(is_generating=False)
+            if appended_elements and appended_elements[-1] is not None:
+                # The user message is the last message again: its element leaves the history and the tail
+                # re-renders it in place of the placeholder. No scroll, the chat did not grow.
+                batch.refresh(appended_elements[-1].delete)
+                batch.refresh(tail_refresh_func)
+            else:
+                batch.refresh(chat_refresh_func)
         send_button.props(remove='loading').classes(remove='animate-pulse')
-        await update_chat_display(client, chat_refresh_func, messages_column_id)
         print("UI Helper: API initiate chat failed.")
         return
 
@@ -119,67 +417,114 @@ async def handle_send_message(client: Client, chat_input: ui.input, send_button:
     stream_id = init_response["stream_id"]
     print(f"UI Helper: API initiate success. Session: {new_session_id}, Stream: {stream_id}")
 
-    # Update user message ID in state
-    current_msgs = utils.get_chat_state(client)["current_messages"].copy()
-    user_msg_updated = False
-    for i, msg in enumerate(current_msgs):
-        if msg.get('id') == temp_user_msg_id:
-            current_msgs[i] = {**msg, 'id': actual_user_message_id}; user_msg_updated = True; break
-    if user_msg_updated: utils.update_chat_state(client, current_messages=current_msgs)
-
-    # Update session list and current ID if it was a new chat
+    user_message['id'] = actual_user_message_id # In place; the id is not displayed
+    # Current ID/title if it was a new chat
     if current_session_id is None:
         utils.update_chat_state(client, current_session_id=new_session_id, current_title=user_input[:50])
-        await update_sessions_list(client, sessions_refresh_func)
+
+    # New chat: it goes on top of the session list locally (the server titled it user_input[:50] too)
+    if current_session_id is None:
+        add_session_locally(client, new_session_id, user_input[:50])
+        sessions_refresh_func()
 
     # 4. Stream SSE response
     assistant_response_content = ""
-    placeholder_index = -1
+    assistant_escaped_content = ""
+    # Received text as chunks, joined once per flush rather than copied per token
+    # (html.escape is per character, so escaping each token and appending is exact)
+    chunks: List[str] = []
+    escaped_chunks: List[str] = []
+    loop = asyncio.get_running_loop()
+    pending_chars = 0 # Text received since the last UI flush
+    flushed_len = 0 # Length of the response already shown in the browser
+    last_flush = loop.time()
+
+    def flush_to_ui():
+        """Writes the accumulated response into the placeholder and pushes the new text to the browser."""
+        nonlocal assistant_response_content, assistant_escaped_content, pending_chars, flushed_len, last_flush
+        assistant_response_content = "".join(chunks); chunks[:] = [assistant_response_content]
+        assistant_escaped_content = "".join(escaped_chunks); escaped_chunks[:] = [assistant_escaped_content]
+        # The placeholder dict itself: state list copies (initiate success, earlier pages prepended) are
+        # shallow, so this is the object in the current list; no lookup, no list copy
+        assistant_placeholder['content'] = assistant_response_content
+        assistant_placeholder['_escaped'] = assistant_escaped_content
+        pending_chars = 0
+        last_flush = loop.time()
+        if not client.has_socket_connection:
+            return # Tab away / reconnecting: nothing is queued; the unsent text goes out in one piece once it is back
+        stream_html = _stream_html.get(client.id)
+        if stream_html is not None:
+            # Ship only the new text and append it as a text node in the browser (no escaping needed):
+            # O(delta) bytes per flush instead of re-sending the whole accumulated <pre>
+            delta = assistant_response_content[flushed_len:]
+            client.run_javascript(
+                f"document.querySelector('#c{stream_html.id} pre')?.append({orjson.dumps(delta).decode()})"
+            )
+        else:
+            (tail_refresh_func or chat_refresh_func)() # Placeholder not on screen yet; render it (it is the last message)
+        flushed_len = len(assistant_response_content)
+
+    browser_url = sse_client.browser_stream_url(stream_id)
+    stream_html = _stream_html.get(client.id)
     try:
-        print(f"UI Helper: Starting SSE stream for {stream_id}")
-        cookies_to_pass = api_client._client.cookies # Get current cookies from shared client
-        async for token in sse_client.stream_chat_responses(stream_id, cookies=cookies_to_pass):
-            if token.startswith("[ERROR]"):
-                assistant_response_content = token; ui.notify(f"Streaming Error: {token}"); break
-            assistant_response_content += token
-
-            # --- Explicitly update placeholder content in state ---
-            current_msgs = utils.get_chat_state(client)["current_messages"].copy()
-            if placeholder_index == -1:
-                 try: placeholder_index = next(i for i, msg in enumerate(current_msgs) if msg.get('id') == temp_assist_msg_id)
-                 except StopIteration: print("ERROR: Placeholder not found!"); break
-            if placeholder_index != -1:
-                # Create a *new* dict for the updated message
-                updated_placeholder = {**current_msgs[placeholder_index], 'content': assistant_response_content}
-                # Create a *new* list with the updated message
-                new_messages_list = current_msgs[:placeholder_index] + [updated_placeholder] + current_msgs[placeholder_index+1:]
-                # Update the state with the new list
-                utils.update_chat_state(client, current_messages=new_messages_list)
-                # Trigger refresh
-                chat_refresh_func()
-                await asyncio.sleep(0.02) # Yield control
+        if browser_url and stream_html is not None:
+            # The browser reads the stream itself; this coroutine only waits for the final text
+            print(f"UI Helper: Browser reads SSE stream {stream_id}")
+            result = await _stream_in_browser(client, browser_url, stream_html.id)
+            if result.get('error'):
+                error = result['error']
+                assistant_response_content = error if error.startswith("[ERROR]") else f"[ERROR] {error}"
+                ui.notify(f"Streaming Error: {assistant_response_content}")
+            else:
+                assistant_response_content = result.get('text') or ""
+            assistant_escaped_content = html.escape(assistant_response_content)
+        else:
+            print(f"UI Helper: Starting SSE stream for {stream_id}")
+            # Same pooled client (and cookie jar) as the API calls: no new connection or cookie copy per send
+            async for token in sse_client.stream_chat_responses(stream_id):
+                if token.startswith("[ERROR]"):
+                    chunks[:] = [token]; escaped_chunks[:] = [html.escape(token)]
+                    pending_chars = 0 # Replaces the text, so no append; finalization re-renders it
+                    ui.notify(f"Streaming Error: {token}"); break
+                chunks.append(token)
+                escaped_chunks.append(html.escape(token))
+                pending_chars += len(token)
+                since_flush = loop.time() - last_flush
+                if since_flush > UI_FLUSH_SECONDS or (pending_chars >= UI_FLUSH_CHARS and since_flush >= UI_MIN_FLUSH_SECONDS):
+                    flush_to_ui()
+                    if len(assistant_response_content) - flushed_len > MAX_UNSENT_UI_CHARS:
+                        await asyncio.sleep(UI_FLUSH_SECONDS) # Browser not keeping up: read the stream slower
+                    else:
+                        await asyncio.sleep(0) # Let the outbox send the update even when the next chunks are already buffered
 
+            if pending_chars: flush_to_ui() # Final partial batch
+            assistant_response_content = "".join(chunks)
+            assistant_escaped_content = "".join(escaped_chunks)
         print(f"UI Helper: Finished streaming. Length: {len(assistant_response_content)}")
     except Exception as e:
         print(f"UI Helper: SSE Error: {e}"); traceback.print_exc()
         assistant_response_content = f"[ERROR] Stream failed: {e}"; ui.notify(f"Error: {e}")
+        assistant_escaped_content = html.escape(assistant_response_content)
     finally:
         # 5. Finalize state and UI
         print("UI Helper: Finalizing message send.")
-        current_chat_state = utils.get_chat_state(client) # Get latest state
-        current_msgs = current_chat_state["current_messages"]
-        # Remove placeholder and add final message
-        final_messages_list = [m for m in current_msgs if m.get('id') != temp_assist_msg_id]
-        final_assistant_msg_id = f"assist_final_{datetime.datetime.now().timestamp()}"
-        final_assistant_msg = {"role": "assistant", "content": assistant_response_content, "id": final_assistant_msg_id}
-        final_messages_list.append(final_assistant_msg)
-        # Update state, setting generating to false
-        utils.update_chat_state(client, current_messages=final_messages_list, is_generating=False)
+        _stream_html.pop(client.id, None)
+        # The placeholder becomes the final message in place (only where it is still shown)
+        assistant_placeholder.update(content=assistant_response_content, _escaped=assistant_escaped_content)
+        assistant_placeholder.pop('_streaming', None)
+        # Final refresh, no scroll: the scroll anchor has kept the view at the bottom
+        with BatchedUIUpdate(client, messages_column_id) as batch:
+            batch.state(is_generating=False)
+            batch.refresh(tail_refresh_func or chat_refresh_func) # The final message is the tail
         send_button.props(remove='loading').classes(remove='animate-pulse')
-        # Final refresh and scroll
-        await update_chat_display(client, chat_refresh_func, messages_column_id)
-        # Update sessions list timestamp
-        await update_sessions_list(client, sessions_refresh_func)
+        # New chat: it was put on top of the list right after initiate.
+        # Existing chat: it moves to the top of the list, locally (fetch only if it isn't listed)
+        if current_session_id is not None:
+            if touch_session_locally(client, current_session_id):
+                sessions_refresh_func()
+            else:
+                invalidate_sessions(client)
+                run_in_background(client, update_sessions_list(client, sessions_refresh_func))
 
 async def handle_logout_click(): # Renamed inner function
      success = await api_client.api_logout()
@@ -191,137 +536,164 @@ async def handle_logout_click(): # Renamed inner function
 
 
 async def handle_main_chat_page(client: Client):
-    user = await api_client.api_get_current_user()
+    # User and session list are fetched concurrently; the list is in state before the first render
+    user, sessions = await api_client.api_bootstrap()
     if not user: ui.navigate.to(pageRoutes.LOGIN_PATH); return
 
     print(f"Chat Page: Loading for user {user.get('email')}")
     chat_state = utils.get_chat_state(client)
+    utils.update_chat_state(client, sessions_list=prepare_sessions(sessions))
+    client.on_disconnect(lambda: _forget_client(client))
 
     # --- Determine Input/Header Heights  ---
     INPUT_AREA_HEIGHT_PX = 64 
     HEADER_HEIGHT_PX = 50   
     # ---
 
-    # --- Inject CSS for Dark Scrollbar ---
-    scrollbar_track_color = "#1f2937" # Match your dark page background (e.g., gray-800)
-    scrollbar_thumb_color = "#4b5563" # A slightly lighter dark gray (e.g., gray-600)
-    scrollbar_thumb_hover_color = "#6b7280" # Lighter still for hover (e.g., gray-500)
-    scrollbar_width = "8px" # Adjust width as desired (e.g., 6px, 10px)
-
-    ui.add_head_html(f'''
-    <style>
-    /* Target the specific messages column */
-    .messages-column-scrollbar::-webkit-scrollbar {{
-    width: {scrollbar_width};
-    height: {scrollbar_width}; /* For horizontal scrollbars if ever needed */
-    }}
-
-    /* Track */
-    .messages-column-scrollbar::-webkit-scrollbar-track {{
-    background: {scrollbar_track_color};
-    border-radius: {scrollbar_width}; /* Round the track ends */
-    }}
-
-    /* Handle */
-    .messages-column-scrollbar::-webkit-scrollbar-thumb {{
-    background-color: {scrollbar_thumb_color};
-    border-radius: {scrollbar_width};
-    /* Add a border matching the track for a 'padding' effect */
-    /* border: 2px solid {scrollbar_track_color}; */
-    }}
-
-    /* Handle on hover */
-    .messages-column-scrollbar::-webkit-scrollbar-thumb:hover {{
-    background-color: {scrollbar_thumb_hover_color};
-    }}
-
-    /* Firefox Scrollbar Styling */
-    .messages-column-scrollbar {{
-    scrollbar-width: thin; /* Or 'auto' */
-    scrollbar-color: {scrollbar_thumb_color} {scrollbar_track_color}; /* thumb track */
-    }}
-    </style>
-    ''')
-    # --- End CSS Injection ---
+    # CSS and JS helpers are shared head HTML (add_shared_head_html), not injected per page load
+    if sse_client.BROWSER_STREAM_URL:
+        ui.on('chat_stream_done', lambda e: _finish_browser_stream(client, e.args or {}))
+
+    # --- Sessions List: keyed rows, updated in place ---
+    # Rows are created once per session and then only re-labelled / moved / deleted, instead of
+    # rebuilding the whole list (and its click handlers) on every refresh.
+    session_rows: Dict[str, Dict] = {} # session id -> {'row', 'title_label', 'time_label', 'title', 'last_updated_at'}
+    rendered_sessions: list = [] # (id, title, last_updated_at) per row, as last synced
+
+    def render_session_row(session_data: Dict) -> Dict:
+        session_id = session_data.get('id')
+        title = session_data.get('title') or "New Chat"
+        with sessions_column:
+            with ui.row().classes(SESSION_ROW_CLASSES) \
+                .on('click', lambda s_id=session_id: select_chat_session(client, s_id, refresh_chat_messages, MESSAGES_COLUMN_ID)) as row:
+                with ui.column().classes('flex-grow gap-0'):
+                    title_label = ui.label(title).classes('font-medium truncate leading-tight')
+                    time_label = ui.label(session_data.get('_display_time', "...")).classes('text-xs text-gray-500 leading-tight')
+                ui.button(icon='delete', on_click=lambda s_id=session_id: delete_chat_session(client, s_id, sessions_container, refresh_chat_messages, MESSAGES_COLUMN_ID), color='negative') \
+                    .props('flat round dense size=xs').classes('ml-1').on('click.stop')
+        return {'row': row, 'title_label': title_label, 'time_label': time_label,
+                'title': title, 'last_updated_at': session_data.get('last_updated_at')}
+
+    def sessions_container():
+        """Syncs the rendered rows with sessions_list: O(changed rows) element work."""
+        sessions = utils.get_chat_state(client).sessions_list
+        snapshot = [(s.get('id'), s.get('title'), s.get('last_updated_at')) for s in sessions]
+        if snapshot == rendered_sessions:
+            return # Nothing to sync (e.g. a re-fetch returned the same list)
+        rendered_sessions[:] = snapshot
+        print(f"UI: Syncing sessions_container. Count: {len(sessions)}")
+        no_history_label.set_visibility(not sessions)
+        seen = set()
+        for index, session_data in enumerate(sessions):
+            try:
+                session_id = session_data.get('id')
+                seen.add(session_id)
+                entry = session_rows.get(session_id)
+                if entry is None:
+                    entry = session_rows[session_id] = render_session_row(session_data)
+                else:
+                    title = session_data.get('title') or "New Chat"
+                    if entry['title'] != title:
+                        entry['title'] = title; entry['title_label'].set_text(title)
+                    if entry['last_updated_at'] != session_data.get('last_updated_at'):
+                        entry['last_updated_at'] = session_data.get('last_updated_at')
+                        entry['time_label'].set_text(session_data.get('_display_time', "..."))
+                children = sessions_column.default_slot.children
+                if index >= len(children) or children[index] is not entry['row']:
+                    entry['row'].move(sessions_column, target_index=index) # e.g. the chat just used jumps to the top
+            except Exception as e: print(f"ERROR render session: {e}"); traceback.print_exc()
+        for session_id in [s_id for s_id in session_rows if s_id not in seen]:
+            session_rows.pop(session_id)['row'].delete()
 
     # --- Define Refreshable Containers ---
-    @ui.refreshable
-    async def sessions_container():
-        # Read state inside the refreshable
-        current_state = utils.get_chat_state(client) # Get fresh state on each refresh
-        sessions = current_state.get("sessions_list", [])
-        current_session_id = current_state.get("current_session_id")
-        print(f"UI: Rendering sessions_container. Count: {len(sessions)}")
-        if not sessions: ui.label("No history.").classes('p-2 text-xs text-gray-500')
-        else:
-            with ui.column().classes('w-full gap-0'):
-                for session_data in sessions:
-                    try:
-                        session_id = session_data.get('id')
-                        is_selected = session_id == current_session_id
-                        base_classes = 'w-full items-center cursor-pointer p-2 rounded text-sm'
-                        selected_classes = ' hover:bg-red-900'
-                        with ui.row().classes(base_classes + selected_classes) \
-                            .on('click', lambda s_id=session_id: select_chat_session(client, s_id, chat_messages_area.refresh, MESSAGES_COLUMN_ID)):
-                            with ui.column().classes('flex-grow gap-0'):
-                                ts_str = session_data.get('last_updated_at'); time_str = "..."
-                                if isinstance(ts_str, str):
-                                    try:
-                                        if ts_str.endswith('Z'): ts_str = ts_str[:-1] + '+00:00'
-                                        ts = datetime.datetime.fromisoformat(ts_str)
-                                        time_str = ts.strftime("%b %d, %H:%M")
-                                    except ValueError: time_str = ts_str
-                                title = session_data.get('title') or "New Chat"
-                                ui.label(title).classes('font-medium truncate leading-tight')
-                                ui.label(time_str).classes('text-xs text-gray-500 leading-tight')
-                            ui.button(icon='delete', on_click=lambda s_id=session_id: delete_chat_session(client, s_id, sessions_container.refresh, chat_messages_area.refresh, MESSAGES_COLUMN_ID), color='negative') \
-                                .props('flat round dense size=xs').classes('ml-1').on('click.stop')
-                    except Exception as e: print(f"ERROR render session: {e}"); traceback.print_exc()
+    def render_message(msg_data: Dict, is_generating: bool) -> Optional[ui.chat_message]:
+        try:
+            role = msg_data.get('role', 'unknown')
+            raw_content = msg_data.get('content', '')
+            is_user = role == 'user'
+            name = role.capitalize()
+            is_loading = role == 'assistant' and is_generating and msg_data.get('_streaming', False)
+
+            with ui.chat_message(name=name, sent=is_user) as message_element:
+                escaped = msg_data.get('_escaped')
+                if escaped is None: # Escaped once per message and kept on it; content writers update both
+                    escaped = msg_data['_escaped'] = html.escape(raw_content)
+                html_content = render_message_html(escaped)
+                if is_loading:
+                    with ui.row().classes('items-center'):
+                        ui.spinner(size='sm').classes('mr-2')
+                        # Always created (even empty) so the stream loop can write into it
+                        _stream_html[client.id] = ui.html(html_content)
+                else:
+                    ui.html(html_content)
+            return message_element
+        except Exception as e: print(f"ERROR render message: {e}"); traceback.print_exc()
+
+    # Messages are split in two refreshables: everything but the last message (re-rendered on session
+    # switch / new send / finalization) and the last message alone, which is all that changes while streaming.
+    history_column_ref: Dict = {} # Column holding the rendered history (replaced on each refresh)
 
     @ui.refreshable
-    def chat_messages_area():
+    def messages_history():
 
         chat_state = utils.get_chat_state(client) # Get fresh state on each refresh
-        messages_to_render = chat_state.get("current_messages", [])
+        messages_to_render = chat_state.current_messages
 
 
         placeholder_container_classes = 'w-full h-full flex flex-col justify-center items-center text-gray-400'
 
-        if not messages_to_render and not chat_state.get("current_session_id"):
+        if not messages_to_render and not chat_state.current_session_id:
              # Fills height and centers its direct children (icon and label)
              with ui.column().classes(placeholder_container_classes):
                  ui.icon('question_answer', size='xl')
                  ui.label("Select a chat or start a new one.").classes('mt-1') # Added small margin-top
-        elif not messages_to_render and chat_state.get("current_session_id"):
+        elif not messages_to_render and chat_state.current_session_id:
              # Fills height and centers its direct children (icon and label)
              with ui.column().classes(placeholder_container_classes):
                  ui.icon('chat', size='xl')
                  ui.label("Send a message to start the chat!").classes('mt-1')
 
-        for msg_data in messages_to_render:
+        history_column_ref['more'] = None
+        if chat_state.has_more_messages:
+            with ui.row().classes('w-full justify-center') as more_row:
+                ui.button("Load earlier messages", icon='expand_less',
+                          on_click=lambda: load_earlier_messages(client, messages_history.refresh, prepend_to_history)) \
+                    .props('flat dense no-caps size=sm')
+            history_column_ref['more'] = more_row
+
+        is_generating = chat_state.is_generating
+        with ui.column().classes('w-full') as history_column:
+            for msg_data in messages_to_render[:-1]:
+                render_message(msg_data, is_generating)
+        history_column_ref['column'] = history_column
+
+    def append_to_history(messages: list) -> list:
+        """Renders messages at the end of the history without re-rendering it; returns their elements."""
+        with history_column_ref['column']:
+            return [render_message(msg_data, False) for msg_data in messages]
+
+    def prepend_to_history(messages: list, has_more: bool):
+        """Renders an older page at the top of the history without re-rendering what is already there."""
+        index = 0
+        with history_column_ref['column']:
+            for msg_data in messages:
+                element = render_message(msg_data, False)
+                if element is not None:
+                    element.move(target_index=index); index += 1
+        if not has_more and history_column_ref['more'] is not None:
+            history_column_ref['more'].set_visibility(False)
 
-            try:
-                # Check if the message is a placeholder and skip rendering it
-                role = msg_data.get('role', 'unknown')
-                raw_content = msg_data.get('content', '')
-                is_user = role == 'user'
-                name = role.capitalize()
-                is_loading = (role == 'assistant' and
-                            chat_state.get("is_generating", False) and
-                            str(msg_data.get('id', '')).startswith(ASSISTANT_PLACEHOLDER_ID_PREFIX))
-
-                with ui.chat_message(name=name, sent=is_user):
-                    escaped_content = html.escape(raw_content)
-                    pre_style = "white-space: pre-wrap; word-wrap: break-word; font-family: monospace; margin: 0;"
-                    html_content = f'<pre style="{pre_style}">{escaped_content}</pre>'
-                    if is_loading:
-                        with ui.row().classes('items-center'):
-                            ui.spinner(size='sm').classes('mr-2')
-                            if raw_content:
-                                ui.html(html_content)
-                    else:
-                        ui.html(html_content)
-            except Exception as e: print(f"ERROR render message: {e}"); traceback.print_exc()
+    @ui.refreshable
+    def messages_tail():
+        chat_state = utils.get_chat_state(client)
+        is_generating = chat_state.is_generating
+        for msg_data in chat_state.current_messages[-1:]:
+            render_message(msg_data, is_generating)
+
+    def refresh_chat_messages():
+        """Full re-render of the message area (both parts)."""
+        messages_history.refresh()
+        messages_tail.refresh()
 
 
     # --- Build Page Layout ---
@@ -330,8 +702,7 @@ async def handle_main_chat_page(client: Client):
              # Button to toggle left drawer
              ui.button(icon='menu', on_click=lambda: left_drawer.toggle()).props('flat round dense color=white')
              # Bind title from state
-             ui.label().bind_text_from(client.storage['chat'], 'current_title',
-                                     backward=lambda t = utils.get_chat_state(client).get("current_title", "New Chat"): t or "New Chat") \
+             ui.label().bind_text_from(chat_state, 'current_title', backward=lambda t: t or "New Chat") \
                      .classes('text-lg font-semibold ml-2')
         ui.button("Logout", on_click=lambda: handle_logout_click(), icon='logout').props('flat color=white') # Pass client
 
@@ -339,11 +710,12 @@ async def handle_main_chat_page(client: Client):
     with ui.left_drawer(fixed=False, value=False, bordered=True).classes('w-64') as left_drawer:
         with ui.column().classes('w-full h-full'):
             ui.button("New Chat", icon="add_comment",
-                      on_click=lambda: select_chat_session(client, None, chat_messages_area.refresh, MESSAGES_COLUMN_ID), color='#40040b').classes('w-full mb-2')
+                      on_click=lambda: select_chat_session(client, None, refresh_chat_messages, MESSAGES_COLUMN_ID), color='#40040b').classes('w-full mb-2')
             ui.label("History").classes('text-base font-medium mb-1 text-gray-600 px-2')
             ui.separator().classes('mb-2')
-            # Call the refreshable function to render the initial list
-            await sessions_container() # Render sessions list
+            no_history_label = ui.label("No history.").classes('p-2 text-xs text-gray-500')
+            sessions_column = ui.column().classes('w-full gap-0')
+            sessions_container() # Render the initial list
 
 
     # --- Messages Column (Main Content Area) ---
@@ -365,7 +737,9 @@ async def handle_main_chat_page(client: Client):
         
         MESSAGES_COLUMN_ID = messages_column.id
         with messages_column:
-            chat_messages_area()
+            messages_history()
+            messages_tail()
+            ui.element('div').classes('chat-scroll-anchor') # Must stay the last child
 
     # --- Input Container ---
     with ui.row().classes(
@@ -381,19 +755,26 @@ async def handle_main_chat_page(client: Client):
             'mx-auto max-w-none lg:max-w-4xl xl:max-w-5xl '
             ) as input_area_row:
             input_area_row.style(f'height: {INPUT_AREA_HEIGHT_PX}px;')
+            async def send_from_input():
+                if utils.get_chat_state(client).is_generating: return # Already streaming; ignore re-sends
+                try:
+                    await handle_send_message(client, chat_input, send_button, refresh_chat_messages, sessions_container, MESSAGES_COLUMN_ID, messages_tail.refresh, append_to_history)
+                except Exception as e: print(f"UI: Send failed: {e}"); traceback.print_exc()
+
+            # enter.exact: Shift+Enter (newline) is filtered in the browser and never reaches the server;
+            # no event args are sent, and bursts of Enter collapse to the first press per 0.25 s
             chat_input = ui.textarea(placeholder="Type your message...") \
                 .classes('flex-grow') \
                 .props('outlined dense rows=1 max-rows=5 autogrow clearable') \
-                .on('keydown.enter', lambda e: handle_send_message(client, chat_input, send_button, chat_messages_area.refresh, sessions_container.refresh, MESSAGES_COLUMN_ID) if not e.args['shiftKey'] else None, throttle=0.1)
+                .on('keydown.enter.exact.prevent', send_from_input, args=[], throttle=0.25, leading_events=True, trailing_events=False)
             send_button = ui.button(icon='send').props('flat round dense') \
-                .on('click', lambda: handle_send_message(client, chat_input, send_button, chat_messages_area.refresh, sessions_container.refresh, MESSAGES_COLUMN_ID))
+                .on('click', send_from_input, args=[], throttle=0.25, leading_events=True, trailing_events=False)
     # --- End Build Page Layout ---
 
     # --- Initial Data Load ---
     print("UI: Page load - running initial data fetch...")
-    await asyncio.gather(
-        update_sessions_list(client, sessions_container.refresh),
-        # Load initial chat state
-        select_chat_session(client, chat_state.get("current_session_id"), chat_messages_area.refresh, MESSAGES_COLUMN_ID)
-    )
+    # Sessions list already came with api_bootstrap and was rendered above. A page starts as "New Chat"
+    # (fresh client state), which the first render already shows; only a selected session needs loading.
+    if chat_state.current_session_id:
+        await select_chat_session(client, chat_state.current_session_id, refresh_chat_messages, MESSAGES_COLUMN_ID)
     print("UI: Initial data fetch complete.")
\ No newline at end of file
@@ -2,6 +2,7 @@ from nicegui import ui, app, Client
 from email_validator import validate_email, EmailNotValidError
 
 from .. import api_client
+from .. import utils
 from ..pageRoutes import pageRoutes
 
 
@@ -25,7 +26,8 @@ async def handle_signup(client: Client):
 
             if not email or not password or not confirm: error_label.set_text("Fill all fields."); return
 
-            try: validate_email(email)
+            # Syntax only: the deliverability check does blocking DNS lookups on the event loop
+            try: validate_email(email, check_deliverability=False)
             except EmailNotValidError as e: error_label.set_text(f"Invalid email: {e}"); return
 
             if password != confirm: error_label.set_text("Passwords don't match."); return
@@ -37,7 +39,7 @@ async def handle_signup(client: Client):
                 if user_info:
                      login_result = await api_client.api_login(email, password)
                      if login_result and login_result.get("user_id"):
-                         if "chat" in client.storage: del client.storage["chat"]
+                         utils.reset_chat_state(client)
                          print(f"UI: Signed up & logged in: {login_result['email']}")
                          ui.navigate.to(pageRoutes.MAIN_PATH)
                      else: error_label.set_text("Signup ok, auto-login failed."); ui.navigate.to(pageRoutes.LOGIN_PATH)
@@ -1,46 +1,79 @@
 import httpx
-from typing import AsyncGenerator, Optional
+from contextlib import aclosing
+from typing import AsyncGenerator, List, Optional, Tuple
+import orjson
 import os
 
-BACKEND_BASE_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+from . import api_client
 
-# Reuse the client instance if possible, or create a new one for SSE
-_sse_client = httpx.AsyncClient(base_url=BACKEND_BASE_URL, timeout=None) # No timeout for SSE stream
+# Backend URL as the browser sees it. When set, the browser reads the stream itself with EventSource and
+# tokens never pass through this process; unset, stream_chat_responses relays them.
+BROWSER_STREAM_URL = os.getenv("BROWSER_STREAM_URL")
+SSE_CHUNK_SIZE = 4096
 
-async def stream_chat_responses(stream_id: str, cookies: Optional[dict] = None) -> AsyncGenerator[str, None]:
-    """Connects to SSE endpoint and yields tokens."""
+def browser_stream_url(stream_id: str) -> Optional[str]:
+    """Stream URL for the browser's EventSource, or None when streams are relayed through this process."""
+    if not BROWSER_STREAM_URL:
+        return None
+    return f"{BROWSER_STREAM_URL.rstrip('/')}/api/chat/stream/{stream_id}"
+
+async def _iter_sse_events(response: httpx.Response) -> AsyncGenerator[Tuple[str, str], None]:
+    """
+    Splits the raw body into (event, data) pairs. One event = its data: lines joined by "\n", dispatched
+    on the blank line that ends it. Lines are matched as bytes and each event is decoded once, whole,
+    so a UTF-8 character split across chunks is never decoded in halves.
+    """
+    buf = bytearray()
+    event_type = b"message"
+    data_lines: List[bytes] = []
+    async for chunk in response.aiter_bytes(SSE_CHUNK_SIZE):
+        buf += chunk
+        start = 0
+        while (end := buf.find(b"\n", start)) != -1:
+            line = buf[start:end]
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                if data_lines:
+                    yield event_type.decode(), b"\n".join(data_lines).decode("utf-8", "replace")
+                event_type, data_lines = b"message", []
+            elif line.startswith(b"data:"):
+                data = line[5:]
+                data_lines.append(data[1:] if data.startswith(b" ") else data) # Single optional space after the colon
+            elif line.startswith(b"event:"):
+                event_type = bytes(line[6:].strip())
+        del buf[:start] # Keep only the incomplete last line
+
+async def stream_chat_responses(stream_id: str, http_client: Optional[httpx.AsyncClient] = None) -> AsyncGenerator[str, None]:
+    """
+    Connects to SSE endpoint and yields tokens. Streams over the app's API client (or http_client) by
+    default: its pooled HTTP/2 connections and cookie jar, so no second pool or handshake per send.
+    """
     url = f"/api/chat/stream/{stream_id}"
     headers = {"Accept": "text/event-stream"}
-    # Pass cookies explicitly if needed and not automatically handled by client instance
-    request_cookies = cookies or _sse_client.cookies
+    client = http_client or api_client._client
 
     try:
-        async with _sse_client.stream("GET", url, headers=headers, cookies=request_cookies) as response:
+        # timeout=None: the stream stays open for the whole generation, whatever the client's default
+        async with client.stream("GET", url, headers=headers, timeout=None) as response:
             print(f"SSE: Connected to {url}, Status: {response.status_code}")
             response.raise_for_status() # Check for initial connection errors
 
-            async for line in response.aiter_lines():
-
-                if line.startswith("data:"):
-                    prefix = "data: "
-                    if line.startswith(prefix):
-                        data = line[len(prefix):]
-                    elif line.startswith("data:"): # Handle case with no space after colon
-                        data = line[len("data:"):]
-                    else: # Should not happen if line starts with "data:"
-                        continue # Skip malformed lines
-
-                    # print(f"SSE Extracted Data (No Strip): '{data}'") # Log extracted data WITHOUT strip
-
+            async with aclosing(_iter_sse_events(response)) as events:
+                async for event_type, data in events:
+                    if event_type == "error":
+                        try:
+                            data = orjson.loads(data).get("error", data)
+                        except orjson.JSONDecodeError:
+                            pass
+                        print(f"SSE: Received Error: {data}")
+                        yield data # Propagate error message
+                        break
                     if data == "[DONE]": # Optional: Handle explicit done signal
                         print("SSE: Received [DONE] signal.")
                         break
-                    elif data.startswith("[ERROR]"):
-                         print(f"SSE: Received Error: {data}")
-                         yield data # Propagate error message
-                         break
-                    else:
-                        yield data # Yield the actual token/message
+                    yield data # Yield the actual text chunk
 
     except httpx.RequestError as e:
         print(f"SSE Request Error: {e}")
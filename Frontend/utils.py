@@ -1,38 +1,45 @@
+from dataclasses import dataclass, field
 from nicegui import Client
-from typing import Dict
+from typing import Any, Callable, Dict, List, Optional
 
 
-# --- Constants ---
-ASSISTANT_PLACEHOLDER_ID_PREFIX = "assist_placeholder_"
-
 # --- State Management Helpers ---
-def create_chat_state() -> Dict:
-    """Creates the initial structure for chat state."""
-    print("DEBUG: Creating initial chat state")
-    return {
-        "current_session_id": None,
-        "current_messages": [],
-        "sessions_list": [],
-        "is_generating": False,
-        "current_title": "New Chat"
-    }
+@dataclass(slots=True)
+class ChatState:
+    """Per-client chat state. Plain attributes: updates are assignments, nothing is copied or serialized."""
+    current_session_id: Optional[str] = None
+    current_messages: List[Dict[str, Any]] = field(default_factory=list)
+    has_more_messages: bool = False
+    sessions_list: List[Dict[str, Any]] = field(default_factory=list)
+    is_generating: bool = False
+    current_title: str = "New Chat"
+
+# Stored on the Client itself: the state goes away with the client (no disconnect bookkeeping) and a
+# lookup is a single attribute read, not a weakref-keyed dict lookup
+_STATE_ATTR = "_chat_state"
 
-def get_chat_state(client: Client) -> Dict:
-    """Safely gets the chat state, initializing if needed."""
-    if "chat" not in client.storage or not isinstance(client.storage.get("chat"), dict):
+def get_chat_state(client: Client) -> ChatState:
+    """Gets the client's chat state, initializing if needed."""
+    state = getattr(client, _STATE_ATTR, None)
+    if state is None:
         print(f"DEBUG: Initializing chat state for client {client.id}")
-        client.storage["chat"] = create_chat_state()
-    # Ensure essential keys exist
-    state = client.storage["chat"]
-    state.setdefault("current_session_id", None)
-    state.setdefault("current_messages", [])
-    state.setdefault("sessions_list", [])
-    state.setdefault("is_generating", False)
-    state.setdefault("current_title", "New Chat" if not state.get("current_session_id") else "Chat")
+        state = ChatState()
+        setattr(client, _STATE_ATTR, state)
     return state
 
+def reset_chat_state(client: Client):
+    """Drops the client's chat state (e.g. after login as a different user)."""
+    client.__dict__.pop(_STATE_ATTR, None)
+
 def update_chat_state(client: Client, **kwargs):
-    """Updates the chat state explicitly by reassigning the dict."""
-    current_state = get_chat_state(client).copy()
-    current_state.update(kwargs)
-    client.storage["chat"] = current_state # Reassign the entire dict
\ No newline at end of file
+    """Sets the given ChatState attributes that actually change (lists by identity, not element-wise)."""
+    state = get_chat_state(client)
+    for name, value in kwargs.items():
+        current = getattr(state, name)
+        if current is value or (not isinstance(value, list) and current == value):
+            continue
+        setattr(state, name, value)
+
+def mutate_messages(client: Client, fn: Callable[[List[Dict[str, Any]]], None]):
+    """Edits current_messages in place via fn (append, index assignment, ...); no list copy."""
+    fn(get_chat_state(client).current_messages)
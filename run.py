@@ -3,51 +3,130 @@ import uvicorn
 import os
 from dotenv import load_dotenv
 import asyncio # Import asyncio
+import sys
+import importlib.util
+from dataclasses import dataclass
+from typing import Optional
 
-# Try installing and using winloop for potentially better performance/stability on Windows
-try:
-    import winloop
-    print("Attempting to use winloop event loop policy.")
-    asyncio.set_event_loop_policy(winloop.EventLoopPolicy())
-except ImportError:
-    print("winloop not found, using default asyncio event loop.")
-    pass # Fallback to default if winloop is not installed
+# Elsewhere uvicorn's loop= setting picks uvloop in every worker after it starts. uvicorn has no winloop
+# option, so on Windows the policy is set here; it takes effect for a single process without the reloader.
+if sys.platform == "win32":
+    try:
+        import winloop
+        print("Attempting to use winloop event loop policy.")
+        asyncio.set_event_loop_policy(winloop.EventLoopPolicy())
+    except ImportError:
+        print("winloop not found, using default asyncio event loop.")
+        pass # Fallback to default if winloop is not installed
 
 # Load environment variables first
 load_dotenv()
 
-# Import the FastAPI app instance from the backend
-from Backend.main import app as fastapi_app
-# Import the NiceGUI initialization function from the frontend
-from Frontend.main import init_nicegui
+def _env_bool(name: str, default: bool) -> bool:
+    """Reads a boolean env var: 1/true/yes/on (any case) are true, anything else set is false."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().casefold() in ("1", "true", "yes", "on")
 
-# Initialize NiceGUI by mounting it onto the FastAPI app
-init_nicegui(fastapi_app)
+@dataclass(frozen=True, slots=True)
+class ServerConfig:
+    """Server settings, read from the environment once at startup."""
+    host: str
+    port: int
+    reload: bool
+    workers: int
+    loop: str
+    log_level: str
+    # Overload protection: past limit_concurrency connections/tasks uvicorn answers 503 instead of queueing.
+    # NiceGUI websockets and SSE streams are long-lived and count too (frontend calls to the backend as well).
+    limit_concurrency: int
+    backlog: int
+    limit_max_requests: Optional[int] # Recycles workers; only with WORKERS > 1, where the supervisor restarts them
+    server: str # "uvicorn", or "granian" (Rust HTTP/websocket layer) when installed; reload always uses uvicorn
 
-if __name__ == "__main__":
-    port = int(os.getenv("PORT", 8000)) # Allow port override via env var
-    host = os.getenv("HOST", "0.0.0.0")
-    reload = os.getenv("RELOAD", "true").lower() == "true" # Allow disabling reload
-
-    # Check if adapter path exists before starting
-    adapter_path = os.getenv("ADAPTER_PATH")
-    if not adapter_path or not os.path.exists(adapter_path):
-         print("-" * 50)
-         print(f"ERROR: LLM Adapter path not found or not set: {adapter_path}")
-         print("Please ensure ADAPTER_PATH in your .env file points to the correct directory.")
-         print("-" * 50)
-         # Optionally exit here if model is critical for startup
-         # import sys
-         # sys.exit(1)
-    else:
-         print(f"Found adapter path: {adapter_path}")
+    @classmethod
+    def from_env(cls) -> "ServerConfig":
+        reload = _env_bool("RELOAD", True) # Allow disabling reload
+        server = os.getenv("SERVER", "uvicorn").lower()
+        if server == "granian" and (reload or importlib.util.find_spec("granian") is None):
+            print("granian not used (not installed, or reload enabled), falling back to uvicorn.")
+            server = "uvicorn"
+        return cls(
+            host=os.getenv("HOST", "0.0.0.0"),
+            port=int(os.getenv("PORT", 8000)), # Allow port override via env var
+            reload=reload,
+            # Each worker is a full process: its own LLM copy and its own NiceGUI clients (a browser's websocket
+            # must stay on one worker) and, without REDIS_URL, its own stream contexts. Hence 1 by default.
+            workers=1 if reload else int(os.getenv("WORKERS", 1)),
+            loop=os.getenv("EVENT_LOOP", "auto"), # "asyncio" forces the stock loop (e.g. for profiling runs)
+            log_level=os.getenv("LOG_LEVEL", "warning").lower(), # uvicorn only knows lowercase names; the backend uppercases the same variable
+            limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", 512)),
+            backlog=int(os.getenv("BACKLOG", 2048)),
+            limit_max_requests=int(os.environ["MAX_REQUESTS"]) if os.getenv("MAX_REQUESTS") else None,
+            server=server,
+        )
+
+cfg = ServerConfig.from_env()
+
+# With the reloader or several workers the main process only supervises: the app (model, NiceGUI mount)
+# is loaded in the processes that serve it, which import this module as "run"
+if __name__ != "__main__" or (not cfg.reload and cfg.workers == 1 and cfg.server == "uvicorn"):
+    # Import the FastAPI app instance from the backend
+    from Backend.main import app as fastapi_app
+    # Import the NiceGUI initialization function from the frontend
+    from Frontend.main import init_nicegui
 
+    # Initialize NiceGUI by mounting it onto the FastAPI app
+    init_nicegui(fastapi_app)
 
-    print(f"Starting server on {host}:{port} with reload={'enabled' if reload else 'disabled'}...")
-    uvicorn.run(
-        "run:fastapi_app", # Point to the app instance in *this* run.py file
-        host=host,
-        port=port,
-        reload=reload,
-        reload_dirs=["backend", "frontend"] # Watch backend and frontend folders for changes
-    )
\ No newline at end of file
+if __name__ == "__main__":
+
+    print(f"Starting {cfg.server} on {cfg.host}:{cfg.port} with reload={'enabled' if cfg.reload else 'disabled'}, workers={cfg.workers}, loop={cfg.loop}...")
+    # "auto": uvloop on Linux/macOS (shipped with uvicorn[standard]), asyncio elsewhere. uvicorn creates the
+    # loop itself before importing the app, so this is the place to choose it, not init_nicegui.
+    if cfg.server == "granian":
+        from granian import Granian
+        from granian.constants import Interfaces, Loops
+        # Workers import this module as "run" (the main process only supervises)
+        Granian(
+            "run:fastapi_app",
+            address=cfg.host,
+            port=cfg.port,
+            interface=Interfaces.ASGI,
+            workers=cfg.workers,
+            loop=Loops.uvloop if cfg.loop in ("auto", "uvloop") and sys.platform != "win32" else Loops.asyncio,
+            backlog=cfg.backlog,
+        ).serve()
+    elif cfg.reload:
+        # Development: the reloader supervises a single process
+        uvicorn.run(
+            "run:fastapi_app", # Point to the app instance in *this* run.py file
+            host=cfg.host,
+            port=cfg.port,
+            reload=True,
+            loop=cfg.loop,
+            reload_dirs=["Backend", "Frontend"], # Watch backend and frontend folders for changes
+            # Source files only (filters apply with watchfiles, part of uvicorn[standard])
+            reload_includes=["*.py", "*.html", "*.css", "*.js"],
+            reload_excludes=["*.pyc", "__pycache__/*", "*.safetensors", "*.bin"],
+            reload_delay=0.5,
+        )
+    else:
+        uvicorn.run(
+            # One worker: the app object itself, so this module isn't imported a second time as "run".
+            # Several workers: uvicorn needs the import string to load the app in each process.
+            "run:fastapi_app" if cfg.workers > 1 else fastapi_app,
+            host=cfg.host,
+            port=cfg.port,
+            workers=cfg.workers,
+            loop=cfg.loop,
+            http="auto", # httptools (C parser, part of uvicorn[standard]) when installed, h11 otherwise
+            ws="websockets",
+            access_log=False, # No per-request log line; the app logs what matters itself
+            log_level=cfg.log_level,
+            limit_concurrency=cfg.limit_concurrency,
+            backlog=cfg.backlog,
+            limit_max_requests=cfg.limit_max_requests if cfg.workers > 1 else None,
+            timeout_keep_alive=5,
+        )